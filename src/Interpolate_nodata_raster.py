@@ -1,5 +1,6 @@
 import numpy as np
 from osgeo import gdal
+from scipy.ndimage import convolve
 
 
 def read_raster(raster_path):
@@ -49,6 +50,88 @@ def bilinear_interpolation(input_array, nodata_value):
     return filled_array
 
 
+def neighbour_average_fill(input_array, nodata_value, connectivity=4, max_distance=None):
+    """
+    Fills NoData values ring by ring with the average of their valid 4- or 8-neighbours.
+    Each pass is computed for the whole array at once from convolutions of the masked values and of the
+    valid-cell counts, and fills the cells that touch a valid cell, like one call of bilinear_interpolation
+    (edges included). Passes are repeated until all holes are closed or max_distance rings have been filled.
+
+    Args:
+    - input_array: The 2D array representing the raster.
+    - nodata_value: The value representing NoData in the array (NaN cells are treated as NoData too).
+    - connectivity: 4 (top, bottom, left, right) or 8 (including diagonals) neighbours.
+    - max_distance: maximum number of rings (in cells) to fill, None to close every hole.
+
+    Returns:
+    - Array with NoData values filled; cells further than max_distance from valid data keep nodata_value.
+    """
+    if connectivity == 4:
+        kernel = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype=np.float64)
+    elif connectivity == 8:
+        kernel = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=np.float64)
+    else:
+        raise ValueError("connectivity must be 4 or 8")
+
+    filled = input_array.astype(np.float64)
+    valid = ~np.isnan(filled)
+    if nodata_value is not None:
+        valid &= filled != nodata_value
+
+    distance = 0
+    while not valid.all() and (max_distance is None or distance < max_distance):
+        sums = convolve(np.where(valid, filled, 0.0), kernel, mode='constant', cval=0.0)
+        counts = convolve(valid.astype(np.float64), kernel, mode='constant', cval=0.0)
+        ring = ~valid & (counts > 0)
+        if not ring.any():
+            break  # Only holes without any valid data left
+        filled[ring] = sums[ring] / counts[ring]
+        valid |= ring
+        distance += 1
+
+    filled[~valid] = nodata_value if nodata_value is not None else np.nan
+    return filled.astype(input_array.dtype) if input_array.dtype.kind == 'f' else filled
+
+
+def fill_raster_blockwise(input_path, output_path, connectivity=4, max_distance=100, block_size=1024):
+    """
+    Streams a raster through neighbour_average_fill block by block with GDAL windows.
+    Every block is read with a halo of max_distance cells, so the filled values equal those of a
+    whole-raster fill while memory stays bounded by the block size. The halo needs a bound, so max_distance
+    must be finite here (filling until every hole is closed is only possible with neighbour_average_fill).
+    """
+    if max_distance is None:
+        raise ValueError("fill_raster_blockwise needs a finite max_distance to size the halo of the blocks.")
+
+    src_ds = gdal.Open(input_path)
+    band = src_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(output_path, cols, rows, 1, gdal.GDT_Float32,
+                           options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    out_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    out_ds.SetProjection(src_ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+    if nodata is not None:
+        out_band.SetNoDataValue(nodata)
+
+    for y in range(0, rows, block_size):
+        for x in range(0, cols, block_size):
+            x0, y0 = max(0, x - max_distance), max(0, y - max_distance)
+            x1, y1 = min(cols, x + block_size + max_distance), min(rows, y + block_size + max_distance)
+            block = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float32)
+            filled = neighbour_average_fill(block, nodata, connectivity, max_distance)
+            core = filled[y - y0:min(rows, y + block_size) - y0, x - x0:min(cols, x + block_size) - x0]
+            out_band.WriteArray(core, x, y)
+
+    out_band.FlushCache()
+    out_ds.FlushCache()
+    out_ds = None
+    src_ds = None
+
+
 def write_raster(output_path, array, transform, nodata_value, reference_path):
     """
     Writes the interpolated array to a new raster file.
@@ -67,18 +150,24 @@ def write_raster(output_path, array, transform, nodata_value, reference_path):
     out_ds.FlushCache()
 
 
-def main(dtm_path, dsm_path, dtm_output, dsm_output):
-    # Read the DTM and DSM rasters
-    dtm_array, dtm_nodata, transform = read_raster(dtm_path)
-    dsm_array, dsm_nodata, _ = read_raster(dsm_path)
-
-    # Interpolate NoData values in DTM and DSM using bilinear interpolation
-    dtm_filled = bilinear_interpolation(dtm_array, dtm_nodata)
-    dsm_filled = bilinear_interpolation(dsm_array, dsm_nodata)
-
-    # Write the filled arrays to new raster files
-    write_raster(dtm_output, dtm_filled, transform, dtm_nodata, dtm_path)
-    write_raster(dsm_output, dsm_filled, transform, dsm_nodata, dsm_path)
+def main(dtm_path, dsm_path, dtm_output, dsm_output, method='bilinear', connectivity=4, max_distance=100,
+         block_size=1024):
+    if method == 'convolution':
+        # Fill DTM and DSM block by block with the vectorized multi-pass neighbour average
+        fill_raster_blockwise(dtm_path, dtm_output, connectivity, max_distance, block_size)
+        fill_raster_blockwise(dsm_path, dsm_output, connectivity, max_distance, block_size)
+    else:
+        # Read the DTM and DSM rasters
+        dtm_array, dtm_nodata, transform = read_raster(dtm_path)
+        dsm_array, dsm_nodata, _ = read_raster(dsm_path)
+
+        # Interpolate NoData values in DTM and DSM using bilinear interpolation
+        dtm_filled = bilinear_interpolation(dtm_array, dtm_nodata)
+        dsm_filled = bilinear_interpolation(dsm_array, dsm_nodata)
+
+        # Write the filled arrays to new raster files
+        write_raster(dtm_output, dtm_filled, transform, dtm_nodata, dtm_path)
+        write_raster(dsm_output, dsm_filled, transform, dsm_nodata, dsm_path)
 
     print(f"Filled DTM saved to: {dtm_output}")
     print(f"Filled DSM saved to: {dsm_output}")
@@ -1,10 +1,18 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+
 import rasterio
 import numpy as np
-from rasterio.warp import reproject, Resampling
+from rasterio.warp import reproject, transform_bounds, Resampling
 from rasterio.transform import from_origin
-from rasterio.windows import from_bounds
+from rasterio.windows import from_bounds, Window
 from rasterio.errors import WindowError
 
+from pre_processing_new import snap_window
+
+# Alignment plans already computed in this process, keyed by (source grid, target grid, block size)
+_alignment_plans = {}
+
 
 def align_raster(source_path, target_path, output_path):
     """
@@ -24,9 +32,8 @@ def align_raster(source_path, target_path, output_path):
             source_data = src.read(1)  # Read the first band
             source_meta = src.meta.copy()
 
-        # Read target raster
+        # Only the grid of the target is needed, its pixels are never read
         with rasterio.open(target_path) as tgt:
-            target_data = tgt.read(1)  # Read the first band
             target_meta = tgt.meta.copy()
 
         # Calculate the intersection of source and target bounds
@@ -71,7 +78,7 @@ def align_raster(source_path, target_path, output_path):
         })
 
         # Align the clipped raster to the target raster
-        aligned_data = np.empty_like(target_data, dtype=np.float32)
+        aligned_data = np.empty((target_meta['height'], target_meta['width']), dtype=np.float32)
         reproject(
             source=source_clipped,
             destination=aligned_data,
@@ -106,6 +113,139 @@ def align_raster(source_path, target_path, output_path):
         raise
 
 
+def grid_signature(dataset):
+    """
+    Identifies the pixel grid of an open raster: CRS, transform and shape.
+    """
+    return dataset.crs.to_wkt() if dataset.crs else None, tuple(dataset.transform)[:6], dataset.width, dataset.height
+
+
+def alignment_plan(src, target_grid, block_size=1024):
+    """
+    Computes, once per (source grid, target grid), which window of the source every block of the target needs.
+
+    Parameters:
+        src: Open source raster.
+        target_grid (dict): Grid of the target with the keys crs, transform, width and height.
+        block_size (int): Edge length of the target blocks in pixels.
+
+    Returns:
+        list of (target window, source window) pairs, only for the blocks that overlap the source.
+    """
+    key = (grid_signature(src), (target_grid['crs'].to_wkt(), tuple(target_grid['transform'])[:6],
+                                 target_grid['width'], target_grid['height']), block_size)
+    if key in _alignment_plans:
+        return _alignment_plans[key]
+
+    plan = []
+    for row in range(0, target_grid['height'], block_size):
+        for col in range(0, target_grid['width'], block_size):
+            target_window = Window(col, row, min(block_size, target_grid['width'] - col),
+                                   min(block_size, target_grid['height'] - row))
+            block_bounds = rasterio.windows.bounds(target_window, target_grid['transform'])
+            if src.crs and src.crs != target_grid['crs']:
+                block_bounds = transform_bounds(target_grid['crs'], src.crs, *block_bounds, densify_pts=21)
+
+            # Pad with the resampling kernel, which grows with the number of source pixels per target pixel
+            window = from_bounds(*block_bounds, transform=src.transform)
+            pad = 2 + math.ceil(max(window.width / target_window.width, window.height / target_window.height))
+            window = Window(window.col_off - pad, window.row_off - pad, window.width + 2 * pad,
+                            window.height + 2 * pad)
+            source_window = snap_window(window, src.width, src.height)
+            if source_window.width > 0 and source_window.height > 0:
+                plan.append((target_window, source_window))
+
+    _alignment_plans[key] = plan
+    return plan
+
+
+def _align_block(task):
+    """
+    Worker: warps the source window of one target block onto that block.
+    """
+    target_window, source_window = task["target_window"], task["source_window"]
+    with rasterio.open(task["source_path"]) as src:
+        source_data = src.read(1, window=source_window)
+        source_transform = src.window_transform(source_window)
+        source_crs = src.crs
+
+    aligned_block = np.zeros((int(target_window.height), int(target_window.width)), dtype=np.float32)
+    reproject(
+        source=source_data,
+        destination=aligned_block,
+        src_transform=source_transform,
+        src_crs=source_crs,
+        dst_transform=rasterio.windows.transform(target_window, task["target_transform"]),
+        dst_crs=task["target_crs"],
+        resampling=task["resampling"],
+    )
+    return task["output_index"], target_window, aligned_block
+
+
+def align_rasters(source_paths, target_path, output_paths, block_size=1024, max_workers=None,
+                  resampling=Resampling.bilinear):
+    """
+    Aligns several source rasters to the grid of one target raster (batch version of align_raster).
+
+    The target is only opened for its grid. For every source the windows needed by each target block are computed
+    once and cached per (source grid, target grid), so sources on the same grid share one plan. All blocks of all
+    sources are warped in parallel from their own source window, and memory per worker is bounded by the block size.
+
+    Parameters:
+        source_paths (list): Paths to the source rasters (e.g. DEM, DSM, tree CHM, building raster).
+        target_path (str): Path to the raster that defines the grid.
+        output_paths (list): Paths to save the aligned rasters, one per source.
+        block_size (int): Edge length of the blocks in target pixels.
+        max_workers (int): Number of worker processes (1 warps the blocks in this process).
+        resampling: rasterio Resampling method.
+
+    Returns:
+        list: output_paths.
+    """
+    if len(source_paths) != len(output_paths):
+        raise ValueError("One output path is needed per source raster.")
+
+    with rasterio.open(target_path) as tgt:
+        target_meta = tgt.meta.copy()
+    target_grid = {key: target_meta[key] for key in ('crs', 'transform', 'width', 'height')}
+
+    tasks = []
+    for output_index, source_path in enumerate(source_paths):
+        with rasterio.open(source_path) as src:
+            plan = alignment_plan(src, target_grid, block_size)
+        if not plan:
+            raise ValueError(f"No overlapping area between {source_path} and the target raster.")
+        tasks.extend({"source_path": source_path, "output_index": output_index, "target_window": target_window,
+                      "source_window": source_window, "target_transform": target_meta['transform'],
+                      "target_crs": target_meta['crs'], "resampling": resampling}
+                     for target_window, source_window in plan)
+    print(f"Aligning {len(source_paths)} rasters in {len(tasks)} blocks")
+
+    # Same output metadata as align_raster, tiled so that blocks are written independently
+    aligned_meta = target_meta.copy()
+    aligned_meta.update({"dtype": "float32", "nodata": 0, "compress": "deflate"})
+    if target_meta['width'] >= 256 and target_meta['height'] >= 256:
+        aligned_meta.update({"tiled": True, "blockxsize": 256, "blockysize": 256})
+
+    outputs = [rasterio.open(output_path, "w", **aligned_meta) for output_path in output_paths]
+    try:
+        if max_workers == 1:
+            results = map(_align_block, tasks)
+            for output_index, target_window, aligned_block in results:
+                outputs[output_index].write(aligned_block, 1, window=target_window)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for output_index, target_window, aligned_block in executor.map(_align_block, tasks):
+                    outputs[output_index].write(aligned_block, 1, window=target_window)
+    finally:
+        for dst in outputs:
+            dst.close()
+
+    for output_path in output_paths:
+        print(f"Aligned raster saved to: {output_path}")
+    return output_paths
+
+
 # source_raster = r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_building_utm.tif'
 # target_raster = r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_tree_32631.tif"
 # output_raster = r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_building_utm_a.tif"
@@ -160,5 +300,6 @@ def resample_raster_to_1m(input_raster, output_raster):
 
     print(f"Raster resampled to 1m resolution: {output_raster}")
 
-# Example usage:
-resample_raster_to_1m(r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm_a.tif", r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm_f.tif")
+if __name__ == "__main__":
+    # Example usage:
+    resample_raster_to_1m(r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm_a.tif", r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm_f.tif")
@@ -2,9 +2,12 @@ import rasterio
 from rasterio.enums import Resampling
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import numpy as np
-from scipy.interpolate import griddata
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
 from rasterio.merge import merge
 
+from raster_io import in_memory_raster, read_raster, write_raster
+
 
 def align_and_crop_dem_to_building(dem_path, building_path, output_tif_path):
     """
@@ -52,75 +55,152 @@ def align_and_crop_dem_to_building(dem_path, building_path, output_tif_path):
     return aligned_dem_data, profile, dem_nodata
 
 
-def fill_missing_values_with_idw(dem_data, dem_nodata):
+def _fill_block(block, core, method, k, power):
+    """
+    Fills the NaN cells inside the core slices of a block (core plus halo) and returns the filled core.
+    Only valid cells of the block are used as sources, so the nearest valid cells of every hole in the core
+    must lie within the halo. Even then, equally distant valid cells are chosen depending on the block layout.
     """
-    Fill missing values in DEM using Inverse Distance Weighting (IDW) interpolation.
+    mask = np.isnan(block)
+    filled = block[core].copy()
+    missing_core = mask[core]
+    if not missing_core.any() or mask.all():
+        return filled
+
+    if method == 'nearest':
+        # Index of the nearest valid cell of every cell, from the Euclidean distance transform
+        nearest_rows, nearest_cols = distance_transform_edt(mask, return_distances=False, return_indices=True)
+        filled[missing_core] = block[nearest_rows[core][missing_core], nearest_cols[core][missing_core]]
+    elif method == 'idw':
+        # True inverse distance weighting from the k nearest valid cells, queried only for the missing cells
+        known_rows, known_cols = np.nonzero(~mask)
+        tree = cKDTree(np.column_stack((known_rows, known_cols)))
+        missing_rows, missing_cols = np.nonzero(missing_core)
+        missing_rows = missing_rows + core[0].start
+        missing_cols = missing_cols + core[1].start
+        k = min(k, len(known_rows))
+        distances, indices = tree.query(np.column_stack((missing_rows, missing_cols)), k=k)
+        distances = distances.reshape(len(missing_rows), k)
+        indices = indices.reshape(len(missing_rows), k)
+        weights = 1.0 / distances ** power
+        known_values = block[known_rows, known_cols].astype(np.float64)
+        filled[missing_core] = (weights * known_values[indices]).sum(axis=1) / weights.sum(axis=1)
+    else:
+        raise ValueError(f"Unknown fill method '{method}', expected 'nearest' or 'idw'.")
+
+    return filled
+
+
+def _block_windows(height, width, block_size, halo):
+    # Yields (row/col slices of the block with its halo, core slices relative to that block, core slices in the grid)
+    block_size = block_size or max(height, width)
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            row_stop, col_stop = min(row + block_size, height), min(col + block_size, width)
+            outer = (slice(max(0, row - halo), min(height, row_stop + halo)),
+                     slice(max(0, col - halo), min(width, col_stop + halo)))
+            core = (slice(row - outer[0].start, row_stop - outer[0].start),
+                    slice(col - outer[1].start, col_stop - outer[1].start))
+            yield outer, core, (slice(row, row_stop), slice(col, col_stop))
+
+
+def fill_missing_values_with_idw(dem_data, dem_nodata, method='nearest', k=8, power=2, block_size=None, halo=256):
+    """
+    Fill missing values in DEM from the surrounding valid cells.
+
+    Parameters:
+    - dem_data: 2D DEM array.
+    - dem_nodata: nodata value of the DEM (NaN cells are always treated as missing).
+    - method: 'nearest' copies the value of the nearest valid cell (exact, from a Euclidean distance transform),
+      'idw' computes the inverse distance weighted mean of the k nearest valid cells with a KD-tree that is
+      queried for the missing cells only.
+    - k, power: number of neighbours and distance exponent for 'idw'.
+    - block_size: if set, the DEM is filled in blocks of this many cells with a halo of `halo` cells around each
+      block, so the distance transform / KD-tree stays small. Holes wider than the halo are filled from the
+      valid cells inside the halo only; cells with no valid cell in their block and halo stay NaN.
+      Blocked fills are not identical to a whole-array fill: when several valid cells are equally far from a
+      hole, which one is used depends on the block layout. With 'idw' such ties at the k-th neighbour are
+      common on a regular grid, so a large share of the filled cells can differ.
     """
     # Create a mask for missing values using the nodata value from the DEM
-    if dem_nodata is not None and dem_nodata != np.nan:
+    dem_data = dem_data.astype(np.float32) if dem_data.dtype.kind != 'f' else dem_data
+    if dem_nodata is not None and not np.isnan(dem_nodata):
         dem_data = np.where(dem_data == dem_nodata, np.nan, dem_data)
 
-        # Create a mask for missing values (NaN)
+    # Create a mask for missing values (NaN)
     mask = np.isnan(dem_data)
-
-    # Debug: Check mask stats
-    print("Mask Stats:")
     print(f"Mask Shape: {mask.shape}, Missing Values Count: {np.sum(mask)}")
 
-    # Get coordinates of known and missing values
-    known_y, known_x = np.where(~mask)
-    known_values = dem_data[~mask]
-
-    missing_y, missing_x = np.where(mask)
-
-    # Debug: Check coordinates
-    print("Known Values Stats:")
-    print(f"Known Points Count: {len(known_values)}")
-    print(f"Known Points Sample: {known_values[:10]} (if available)")
-    print("Missing Values Stats:")
-    print(f"Missing Points Count: {len(missing_y)}")
-
     # Check if there are no missing values
-    if len(missing_y) == 0:
+    if not mask.any():
         print("No missing values to fill. Returning original DEM.")
         return dem_data
 
-    # Create a grid of all coordinates
-    grid_y, grid_x = np.mgrid[0:dem_data.shape[0], 0:dem_data.shape[1]]
+    dem_filled = dem_data.copy()
+    height, width = dem_data.shape
+    for outer, core, target in _block_windows(height, width, block_size, halo if block_size else 0):
+        dem_filled[target] = _fill_block(dem_data[outer], core, method, k, power)
 
-    # Perform IDW interpolation for missing values
-    try:
-        dem_filled = griddata(
-            points=(known_x, known_y),
-            values=known_values,
-            xi=(grid_x, grid_y),
-            method='nearest'
-        )
-    except Exception as e:
-        print("Error during IDW interpolation:", e)
-        return dem_data
-
-    # Debug: Check if dem_filled contains NaNs
-    print("DEM Filled Stats:")
     print(f"Filled DEM NaN Count: {np.isnan(dem_filled).sum()}")
-
     return dem_filled
 
 
-def combine_dem_and_building(dem_filled, building_path, output_path):
+def fill_raster_nodata(input_path, output_path, method='nearest', k=8, power=2, block_size=1024, halo=256):
     """
-    Add building heights on top of the DEM.
+    Block-wise version of fill_missing_values_with_idw that reads and writes the DEM window by window,
+    so filling scales to city-size rasters. See fill_missing_values_with_idw for the parameters.
     """
-    with rasterio.open(building_path) as building:
-        building_data = building.read(1)
-        profile = building.profile  # Move profile access within the 'with' block
+    with rasterio.open(input_path) as src:
+        profile = src.profile
+        profile.update(dtype='float32', nodata=np.nan, tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+        nodata = src.nodata
+
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for outer, core, target in _block_windows(src.height, src.width, block_size, halo):
+                window = rasterio.windows.Window.from_slices(*outer)
+                block = src.read(1, window=window).astype(np.float32)
+                if nodata is not None and not np.isnan(nodata):
+                    block[block == nodata] = np.nan
+                dst.write(_fill_block(block, core, method, k, power), 1,
+                          window=rasterio.windows.Window.from_slices(*target))
+
+    print(f"Filled DEM saved to {output_path}")
+    return output_path
+
+
+def combine_dem_rasters(dem, building):
+    """
+    Adds building heights on top of a DEM on the same grid, in memory.
+
+    :param dem: in-memory raster of the DEM (see raster_io.in_memory_raster)
+    :param building: in-memory raster of the building layer
+    :return: in-memory raster of the combined DEM, on the grid of the building layer
+    """
+    if dem["data"].shape != building["data"].shape:
+        raise ValueError("The DEM and the building layer are not on the same grid.")
 
     # Combine DEM and building layers, giving preference to building data
-    combined_dem = np.where(building_data > 0, dem_filled + building_data, dem_filled)
+    building_data = building["data"]
+    combined_dem = np.where(building_data > 0, dem["data"] + building_data, dem["data"])
+    return in_memory_raster(combined_dem, building["transform"], building["crs"], dem["nodata"])
+
+
+def combine_dem_and_building(dem_filled, building_path, output_path):
+    """
+    Add building heights on top of the DEM.
+
+    :param dem_filled: DEM array on the grid of the building layer, in-memory raster or path of a raster
+    :param building_path: path of the building raster or in-memory raster
+    :param output_path: path of the combined GeoTIFF
+    """
+    building = read_raster(building_path)
+    if isinstance(dem_filled, np.ndarray):
+        dem = in_memory_raster(dem_filled, building["transform"], building["crs"])
+    else:
+        dem = read_raster(dem_filled)
 
-    # Save combined DEM + building layer
-    with rasterio.open(output_path, 'w', **profile) as dst:
-        dst.write(combined_dem, 1)
+    # Save combined DEM + building layer, in the data type of the DEM
+    write_raster(combine_dem_rasters(dem, building), output_path)
 
     print(f"Combined DEM and building layers saved to {output_path}")
     return output_path
@@ -236,18 +316,19 @@ def process_divided_patches(dem1_path, dem2_path, building1_path, building2_path
 
     return combined_path
 
-process_divided_patches(
-    dem1_path=r'C:\Users\www\WRI-cif\Amsterdam\DEM_patch1.TIF',
-    dem2_path=r'C:\Users\www\WRI-cif\Amsterdam\2023_M_25EZ1.TIF',
-    building1_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p1.tif",
-    building2_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p2.tif",
-    output_dem_p1=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_aoi2_p1.tif",
-    output_dem_p2=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_aoi2_p2.tif",
-    output_dem_not_filled = r"C:\Users\www\WRI\dontwrite",
-    output_filled_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_f_aoi2.tif",
-    building_path = r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_m_aoi2.tif",
-    combined_output_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_building_aoi2.tif"
-)
+if __name__ == "__main__":
+    process_divided_patches(
+        dem1_path=r'C:\Users\www\WRI-cif\Amsterdam\DEM_patch1.TIF',
+        dem2_path=r'C:\Users\www\WRI-cif\Amsterdam\2023_M_25EZ1.TIF',
+        building1_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p1.tif",
+        building2_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p2.tif",
+        output_dem_p1=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_aoi2_p1.tif",
+        output_dem_p2=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_aoi2_p2.tif",
+        output_dem_not_filled = r"C:\Users\www\WRI\dontwrite",
+        output_filled_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_f_aoi2.tif",
+        building_path = r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_m_aoi2.tif",
+        combined_output_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\dem_building_aoi2.tif"
+    )
 # # Specify file paths
 # dem_path = r'C:\Users\www\WRI-cif\Amsterdam\DEM_patch1.TIF'
 # building_path = r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p1.tif"
@@ -4,6 +4,8 @@ from shapely.geometry import Point, box
 from rasterio.windows import from_bounds
 import numpy as np
 
+from vector_io import read_vector_in_bbox
+
 
 def create_2km_bbox(center_x, center_y):
     half_size = 1000  # 1km in each direction for a 2km x 2km bounding box
@@ -62,9 +64,9 @@ def crop_raster(raster_path, bbox):
 
 
 # Function to crop the vector data to the bounding box
-def crop_vector(vector_path, bbox):
-    # Load the vector data
-    gdf = gpd.read_file(vector_path)
+def crop_vector(vector_path, bbox, columns=None):
+    # Load only the features intersecting the bounding box (given in the CRS of the vector file)
+    gdf = read_vector_in_bbox(vector_path, bbox.bounds, columns=columns)
 
     # Clip the vector data to the bounding box
     clipped_gdf = gpd.clip(gdf, bbox)
@@ -1,12 +1,228 @@
+import glob
+import math
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
 import laspy
 from sklearn.cluster import DBSCAN
 from scipy.spatial import ConvexHull
 import scipy
-from shapely.geometry import MultiPoint
+
+from lidar_grid import iter_points_in_bbox, thin_indices
+
+
+def _cluster_tile(task):
+    """
+    Worker: runs DBSCAN on the points of one tile plus a halo of 2 * eps.
+    Core flags are exact for the points within eps of the tile, because their whole eps-neighbourhood lies in the
+    halo; only those points are returned, with the local cluster label DBSCAN gave them.
+    """
+    coords, inner = task["coords"], task["inner"]
+    db = DBSCAN(eps=task["eps"], min_samples=task["min_samples"]).fit(coords)
+    core = np.zeros(len(coords), dtype=bool)
+    core[db.core_sample_indices_] = True
+    return task["tile_id"], task["indices"][inner], core[inner], db.labels_[inner]
+
+
+def _union_find(n_nodes, a, b):
+    """
+    Vectorized union-find: merges the node pairs (a[i], b[i]) and returns the root of every node.
+    The root of a set is its smallest node.
+    """
+    parent = np.arange(n_nodes)
+    while True:
+        # Path compression: point every node straight to its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        root_a, root_b = parent[a], parent[b]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+        # Hook the larger root under the smaller one
+        np.minimum.at(parent, np.maximum(root_a, root_b)[differ], np.minimum(root_a, root_b)[differ])
+
+
+def dbscan_tiled(coords, eps=1.5, min_samples=20, tile_size=250, max_workers=None):
+    """
+    Partitioned DBSCAN: clusters spatial tiles of the point cloud in parallel and stitches the cluster labels
+    across tile borders.
+
+    Every tile is clustered with a halo of 2 * eps, which makes the core flags of all points within eps of the tile
+    exact. Every core-core link of a point in a tile therefore exists in that tile's clustering, and a cluster
+    that crosses a border shares core points between the tiles. The local clusters that share a core point are
+    merged with union-find. Core points and noise are the same as with a single DBSCAN over all points. A border
+    point next to two clusters can end up in either, which single-pass DBSCAN also decides by processing order.
+
+    Parameters:
+    - coords: (N, 2) array of XY coordinates.
+    - eps, min_samples: DBSCAN parameters.
+    - tile_size: tile edge length in coordinate units; memory per worker is bounded by the points of one tile.
+    - max_workers: number of worker processes (1 clusters the tiles in this process).
+
+    Returns:
+    - labels: cluster label of every point, -1 for noise, numbered from 0.
+    """
+    n_points = len(coords)
+    labels = np.full(n_points, -1, dtype=np.int64)
+    if n_points == 0:
+        return labels
+
+    min_x, min_y = coords.min(axis=0)
+    n_cols = max(1, math.ceil((coords[:, 0].max() - min_x) / tile_size + 1e-9))
+    tile_cols = np.minimum(((coords[:, 0] - min_x) // tile_size).astype(np.int64), n_cols - 1)
+    tile_rows = ((coords[:, 1] - min_y) // tile_size).astype(np.int64)
+    tile_ids = tile_rows * n_cols + tile_cols
+
+    # Points sorted by x, so that every column of tiles is one slice
+    x_order = np.argsort(coords[:, 0], kind='stable')
+    sorted_x = coords[x_order, 0]
+
+    tasks = []
+    for tile_id in np.unique(tile_ids):
+        row, col = divmod(int(tile_id), n_cols)
+        x0, y0 = min_x + col * tile_size, min_y + row * tile_size
+        x1, y1 = x0 + tile_size, y0 + tile_size
+        start = np.searchsorted(sorted_x, x0 - 2 * eps, side='left')
+        stop = np.searchsorted(sorted_x, x1 + 2 * eps, side='right')
+        candidates = x_order[start:stop]
+        y = coords[candidates, 1]
+        indices = candidates[(y >= y0 - 2 * eps) & (y <= y1 + 2 * eps)]
+        tile_coords = coords[indices]
+        inner = ((tile_coords[:, 0] >= x0 - eps) & (tile_coords[:, 0] <= x1 + eps) &
+                 (tile_coords[:, 1] >= y0 - eps) & (tile_coords[:, 1] <= y1 + eps))
+        tasks.append({"tile_id": int(tile_id), "coords": tile_coords, "indices": indices, "inner": inner,
+                      "eps": eps, "min_samples": min_samples})
+    print(f"Clustering {n_points} points in {len(tasks)} tiles of {tile_size} x {tile_size}")
+
+    if max_workers == 1:
+        results = list(map(_cluster_tile, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_cluster_tile, tasks))
+
+    # Every (tile, local label) is one node of the union-find
+    node_offsets, n_nodes = {}, 0
+    for tile_id, _, _, tile_labels in results:
+        node_offsets[tile_id] = n_nodes
+        n_nodes += int(tile_labels.max()) + 1 if len(tile_labels) else 0
+
+    point_nodes, point_indices, point_core = [], [], []
+    owned_points, owned_nodes = [], []
+    for tile_id, indices, core, tile_labels in results:
+        clustered = tile_labels >= 0
+        nodes = tile_labels + node_offsets[tile_id]
+        point_indices.append(indices[core])
+        point_nodes.append(nodes[core])
+        # The owning tile decides the label of each point, also of the border points
+        owned = clustered & (tile_ids[indices] == tile_id)
+        owned_points.append(indices[owned])
+        owned_nodes.append(nodes[owned])
+
+    # Local clusters that share a core point are the same cluster
+    point_indices = np.concatenate(point_indices)
+    point_nodes = np.concatenate(point_nodes)
+    order = np.argsort(point_indices, kind='stable')
+    point_indices, point_nodes = point_indices[order], point_nodes[order]
+    shared = point_indices[1:] == point_indices[:-1]
+    roots = _union_find(n_nodes, point_nodes[:-1][shared], point_nodes[1:][shared])
+
+    owned_points = np.concatenate(owned_points)
+    owned_roots = roots[np.concatenate(owned_nodes)]
+    _, labels[owned_points] = np.unique(owned_roots, return_inverse=True)
+    return labels
+
+
+def _hull_geometry(cluster_points):
+    """
+    Convex hull area and aspect ratio of the minimum rotated rectangle of one cluster.
+    The rectangle is found from the hull vertices only: it has a side on one of the hull edges, so every edge
+    direction is tried at once and the one with the smallest box area is kept.
+    Returns NaN for both when the points do not span a hull (fewer than 3 points or collinear).
+    """
+    if len(cluster_points) < 3:
+        return np.nan, np.nan
+    try:
+        hull = ConvexHull(cluster_points)
+    except scipy.spatial.QhullError:
+        return np.nan, np.nan
+
+    vertices = cluster_points[hull.vertices]
+    edges = np.roll(vertices, -1, axis=0) - vertices
+    angles = np.arctan2(edges[:, 1], edges[:, 0])
+    cos, sin = np.cos(angles), np.sin(angles)
+    # Coordinates of all vertices in the frame of every edge: (edges, vertices)
+    along = cos[:, None] * vertices[None, :, 0] + sin[:, None] * vertices[None, :, 1]
+    across = -sin[:, None] * vertices[None, :, 0] + cos[:, None] * vertices[None, :, 1]
+    lengths = along.max(axis=1) - along.min(axis=1)
+    widths = across.max(axis=1) - across.min(axis=1)
+    best = np.argmin(lengths * widths)
+    length, width = max(lengths[best], widths[best]), min(lengths[best], widths[best])
+    return hull.volume, length / width if width > 0 else np.inf
+
+
+def _cluster_geometry_batch(task):
+    """
+    Worker: hull area and aspect ratio of a batch of clusters stored as contiguous slices of one array.
+    """
+    points, bounds = task["points"], task["bounds"]
+    return np.array([_hull_geometry(points[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])]).reshape(-1, 2)
+
+
+def cluster_table(coords, labels, geometry=True, max_workers=1, clusters_per_task=500):
+    """
+    Per-cluster statistics computed from one sort of the points by label, instead of a mask over all points per
+    cluster.
+
+    Parameters:
+    - coords: (N, 2) array of XY coordinates.
+    - labels: cluster label of every point, -1 for noise.
+    - geometry: also compute the convex hull area and the aspect ratio of the minimum rotated rectangle.
+    - max_workers: number of worker processes for the geometry (1 computes it in this process).
+    - clusters_per_task: number of clusters sent to a worker at a time.
+
+    Returns:
+    - table: DataFrame with one row per cluster: label, n_points and (if geometry) hull_area and aspect_ratio.
+    - order: point indices sorted by label; the points of the i-th cluster are order[start[i]:stop[i]].
+    - start, stop: slice of every cluster in order.
+    """
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]]) if len(labels) else \
+        np.empty(0, dtype=np.int64)
+    stops = np.r_[starts[1:], len(labels)]
+
+    # Noise is not a cluster
+    keep = sorted_labels[starts] != -1 if len(starts) else np.empty(0, dtype=bool)
+    starts, stops = starts[keep], stops[keep]
+    table = pd.DataFrame({"label": sorted_labels[starts], "n_points": stops - starts})
+
+    if geometry:
+        sorted_coords = coords[order]
+        tasks = []
+        for batch_start in range(0, len(starts), clusters_per_task):
+            batch_starts = starts[batch_start:batch_start + clusters_per_task]
+            batch_stops = stops[batch_start:batch_start + clusters_per_task]
+            first, last = batch_starts[0], batch_stops[-1]
+            tasks.append({"points": sorted_coords[first:last], "bounds": np.r_[batch_starts, batch_stops[-1]] - first})
+
+        if max_workers == 1:
+            results = list(map(_cluster_geometry_batch, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_cluster_geometry_batch, tasks))
+        geometry_values = np.vstack(results) if results else np.empty((0, 2))
+        table["hull_area"] = geometry_values[:, 0]
+        table["aspect_ratio"] = geometry_values[:, 1]
+
+    return table, order, starts, stops
 
 
-def filter_points(input_laz_path, output_laz_path, min_area_m2=4, eps=1.5, min_samples=20, aspect_ratio_threshold=1):
+def filter_points(input_laz_path, output_laz_path, min_area_m2=4, eps=1.5, min_samples=20, aspect_ratio_threshold=1,
+                  tile_size=None, max_workers=1, cluster_table_path=None, thin_cell_size=None, thin_keep='highest'):
     """
     Filters points to retain clusters based on DBSCAN clustering. Additional filtering by convex hull area
     and aspect ratio is performed only if aspect_ratio_threshold is not set to 1.
@@ -18,103 +234,135 @@ def filter_points(input_laz_path, output_laz_path, min_area_m2=4, eps=1.5, min_s
     - eps: the maximum distance between two samples for one to be considered as in the neighborhood of the other.
     - min_samples: the number of samples in a neighborhood for a point to be considered as a core point.
     - aspect_ratio_threshold: the maximum allowed aspect ratio to retain a cluster, default is 1 (no aspect ratio filtering).
+    - tile_size: if set, cluster in tiles of tile_size x tile_size meters in parallel (see dbscan_tiled) instead of
+      running one DBSCAN over the whole point cloud.
+    - max_workers: number of worker processes for the tiled clustering and the cluster geometry; the default 1
+      runs everything in this process, None starts one process per CPU (the calling script then needs an
+      `if __name__ == "__main__":` guard).
+    - cluster_table_path: optional CSV path for the per-cluster table (point count, hull area, aspect ratio,
+      retained), see cluster_table.
+    - thin_cell_size: if set, keep one point per thin_cell_size x thin_cell_size cell before clustering (see
+      lidar_grid.thin_indices); only the kept points are clustered and written, so min_samples applies to the thinned
+      density.
+    - thin_keep: point kept per cell when thinning: 'highest', 'lowest' or 'random'.
     """
     with laspy.open(input_laz_path) as infile:
         las = infile.read()
+    points = las.points
+
+    if thin_cell_size:
+        kept = thin_indices(np.asarray(las.x), np.asarray(las.y), np.asarray(las.z), thin_cell_size, thin_keep)
+        print(f"Thinned {len(points)} points to {len(kept)} ({len(points) / max(len(kept), 1):.1f}x fewer)")
+        points = points[kept]
 
     # Extract coordinates
-    coords = np.vstack((las.x, las.y)).T
+    coords = np.vstack((points.x, points.y)).T
 
     # Perform DBSCAN clustering
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(coords)
-    labels = db.labels_
-
-    # Collect indices for valid clusters
-    valid_indices = []
-
-    # Analyze each cluster
-    for k in set(labels):
-        if k == -1:  # Ignore noise
-            continue
+    if tile_size:
+        labels = dbscan_tiled(coords, eps=eps, min_samples=min_samples, tile_size=tile_size, max_workers=max_workers)
+    else:
+        db = DBSCAN(eps=eps, min_samples=min_samples).fit(coords)
+        labels = db.labels_
 
-        # Extract points belonging to the current cluster
-        cluster_mask = (labels == k)
-        cluster_points = coords[cluster_mask]
-
-        if aspect_ratio_threshold == 1:
-            # Directly add valid indices without geometric filtering
-            valid_indices.extend(np.where(cluster_mask)[0])
-        else:
-            if len(cluster_points) < 3:
-                continue  # Not enough points to form a convex hull
+    # Analyze all clusters from one sort of the points by label
+    filter_geometry = aspect_ratio_threshold != 1
+    table, order, starts, stops = cluster_table(coords, labels, geometry=filter_geometry or bool(cluster_table_path),
+                                                max_workers=max_workers)
+    if filter_geometry:
+        # Clusters without a valid convex hull compare as False and are dropped
+        keep = (table["hull_area"].to_numpy() > min_area_m2) & \
+               (table["aspect_ratio"].to_numpy() <= aspect_ratio_threshold)
+    else:
+        # Directly keep all clusters without geometric filtering
+        keep = np.ones(len(table), dtype=bool)
+    table["retained"] = keep
 
-            try:
-                # Calculate the convex hull and then the minimum bounding rectangle
-                hull = ConvexHull(cluster_points)
-                if hull.volume > min_area_m2:  # Check the convex hull area
-                    multipoint = MultiPoint(cluster_points)
-                    min_rectangle = multipoint.minimum_rotated_rectangle
+    if cluster_table_path:
+        table.to_csv(cluster_table_path, index=False)
+        print(f"Cluster table saved to {cluster_table_path}")
 
-                    # Calculate the aspect ratio of the minimum bounding rectangle
-                    x, y = min_rectangle.exterior.coords.xy
-                    edge_length = [np.linalg.norm(np.array([x[i], y[i]]) - np.array([x[i + 1], y[i + 1]])) for i in range(len(x) - 1)]
-                    length, width = max(edge_length), min(edge_length)
-                    aspect_ratio = length / width
-
-                    if aspect_ratio <= aspect_ratio_threshold:
-                        valid_indices.extend(np.where(cluster_mask)[0])
-
-            except scipy.spatial.qhull.QhullError:
-                continue  # Skip clusters that cannot form a valid convex hull
-
-    # Ensure indices are unique before writing
-    valid_indices = list(set(valid_indices))  # Remove any duplicates
+    # Indices of the retained points, in file order
+    valid_indices = np.flatnonzero(np.isin(labels, table["label"].to_numpy()[keep]))
 
     # Filtered points ready for writing
-    if valid_indices:
-        vegetation_points = las.points[valid_indices]
+    if len(valid_indices):
+        vegetation_points = points[valid_indices]
         with laspy.open(output_laz_path, mode='w', header=las.header) as writer:
             writer.write_points(vegetation_points)
 
     print(f"Filtered {len(valid_indices)} points into {output_laz_path}")
 
 
-def merge_laz_files(input_file1, input_file2, output_file):
+def merge_laz_tiles(input_files, output_file, bbox=None, chunk_size=2_000_000):
     """
-    Merge two LAZ files into one.
+    Merge any number of LAS/LAZ tiles into one file, streaming the points chunk by chunk.
+
+    Points are copied in chunks of chunk_size into one writer, so memory does not grow with the number or size of the
+    tiles. Tiles whose scales or offsets differ from the output are rescaled on the fly. The point count and the
+    extent of the output header are computed from the points actually written.
 
     Parameters:
-        input_file1 (str): Path to the first LAZ file.
-        input_file2 (str): Path to the second LAZ file.
-        output_file (str): Path for the output merged LAZ file.
+        input_files (list or str): Paths of the tiles, or a glob pattern (e.g. "tiles/*.laz").
+        output_file (str): Path for the output merged LAS/LAZ file.
+        bbox (tuple): Optional (min_x, min_y, max_x, max_y) to crop to while merging.
+        chunk_size (int): Number of points read and written at a time.
+
+    Returns:
+        int: Number of points written.
     """
-    # Read the first LAZ file
-    with laspy.open(input_file1) as las1:
-        points1 = las1.read()
+    if isinstance(input_files, str):
+        input_files = sorted(glob.glob(input_files))
+    if not input_files:
+        raise ValueError("No input files to merge.")
 
-    # Read the second LAZ file
-    with laspy.open(input_file2) as las2:
-        points2 = las2.read()
+    headers = []
+    for input_file in input_files:
+        with laspy.open(input_file) as reader:
+            headers.append(reader.header)
 
     # Check compatibility of the point formats
-    if points1.header.point_format != points2.header.point_format:
-        raise ValueError("Point formats of the two files do not match. Ensure both files have the same point format.")
+    first = headers[0]
+    if any(header.point_format != first.point_format for header in headers[1:]):
+        raise ValueError("Point formats of the input files do not match. Ensure all files have the same point format.")
+
+    # Keep the scales and offsets of the first file if all files share them, otherwise use the finest scale and an
+    # offset at the lower corner of all tiles so that every point fits the integer coordinates
+    merged_header = laspy.LasHeader(point_format=first.point_format, version=first.version)
+    merged_header.vlrs = first.vlrs
+    same_scaling = all(np.array_equal(header.scales, first.scales) and np.array_equal(header.offsets, first.offsets)
+                       for header in headers[1:])
+    if same_scaling:
+        merged_header.scales = first.scales
+        merged_header.offsets = first.offsets
+    else:
+        merged_header.scales = np.min([header.scales for header in headers], axis=0)
+        merged_header.offsets = np.floor(np.min([header.mins for header in headers], axis=0))
 
-    # Merge the point data
-    merged_points = np.hstack([points1.points.array, points2.points.array])
+    point_count = 0
+    with laspy.open(output_file, mode="w", header=merged_header) as las_out:
+        for input_file in input_files:
+            for points in iter_points_in_bbox(input_file, bbox, chunk_size=chunk_size):
+                if not (np.array_equal(points.scales, merged_header.scales) and
+                        np.array_equal(points.offsets, merged_header.offsets)):
+                    points.change_scaling(scales=merged_header.scales, offsets=merged_header.offsets)
+                las_out.write_points(points)
+                point_count += len(points)
 
-    # Create a new LAS header based on the first file's header
-    merged_header = laspy.LasHeader(point_format=points1.header.point_format, version=points1.header.version)
+    print(f"Merged {point_count} points from {len(input_files)} files into {output_file}")
+    return point_count
 
-    # Ensure scales and offsets are carried over
-    merged_scales = points1.header.scales
-    merged_offsets = points1.header.offsets
 
-    # Write the merged points to the output file
-    with laspy.open(output_file, mode="w", header=merged_header) as las_out:
-        las_out.write_points(
-            laspy.ScaleAwarePointRecord(merged_points, point_format=merged_header.point_format, scales=merged_scales,
-                                        offsets=merged_offsets))
+def merge_laz_files(input_file1, input_file2, output_file):
+    """
+    Merge two LAZ files into one.
+
+    Parameters:
+        input_file1 (str): Path to the first LAZ file.
+        input_file2 (str): Path to the second LAZ file.
+        output_file (str): Path for the output merged LAZ file.
+    """
+    return merge_laz_tiles([input_file1, input_file2], output_file)
 
 
 
@@ -1,7 +1,58 @@
 from reproj_vector import crop_reproj_vector
-from rasterize_gpkg import rasterize_gpkg
-from smooth_dem import smooth_dem
-from combine_dem_building_tifs import combine_dem_and_building
+from rasterize_gpkg import rasterize_gdf
+from smooth_dem import smooth_dem_to_grid
+from combine_dem_building_tifs import combine_dem_rasters
+from raster_io import checkpoint, write_raster
+
+
+def build_global_building_dem(utglobus_path, input_nasadem, bbx, output_path=None, target_crs="EPSG:32631",
+                              bbx_crs=None, resolution=1, sigma=1, smoothing='upsample_first', height_column=None,
+                              checkpoints=None):
+    '''
+    Builds a DEM with building heights on top from a global building layer and NASADEM.
+
+    The stages (crop and reproject the buildings, rasterize them, smooth the DEM onto the building grid, combine)
+    pass GeoDataFrames and in-memory rasters to each other, so no intermediate file is written or read back
+    unless it is asked for as a checkpoint.
+
+    :param utglobus_path: path of the building vector layer
+    :param input_nasadem: path of the DEM
+    :param bbx: AOI as {"xmin", "ymin", "xmax", "ymax"} or (minx, miny, maxx, maxy)
+    :param output_path: optional path of the combined GeoTIFF
+    :param target_crs: CRS of the output
+    :param bbx_crs: CRS of bbx, defaults to the CRS of the building layer
+    :param resolution: output resolution in target_crs units
+    :param sigma: standard deviation of the DEM smoothing in output pixels
+    :param smoothing: 'upsample_first' or 'smooth_first', see smooth_dem.smooth_dem_to_grid
+    :param height_column: building attribute burned as height (the highest building wins where footprints
+        overlap); if None, the footprints are burned as 1
+    :param checkpoints: optional dict of paths to save intermediate results to, with the keys 'buildings' (GPKG),
+        'building_raster' and 'dem_smoothed' (GeoTIFF)
+    :return: in-memory raster of the combined DEM (see raster_io.in_memory_raster)
+    '''
+    checkpoints = checkpoints or {}
+
+    # crop and reproject the UTGLOBUS to the aoi
+    buildings = crop_reproj_vector(utglobus_path, checkpoints.get('buildings'), target_crs, bbx, bbx_crs)
+
+    # rasterize the buildings with their heights, this raster defines the output grid
+    if height_column:
+        building_raster = rasterize_gdf(buildings, resolution, value_column=height_column, dtype='float32',
+                                        merge='max')
+    else:
+        building_raster = rasterize_gdf(buildings, resolution)
+    building_raster = checkpoint(building_raster, checkpoints.get('building_raster'))
+
+    # smooth nasadem onto the building grid
+    dem_smoothed = checkpoint(smooth_dem_to_grid(input_nasadem, building_raster, sigma, smoothing),
+                              checkpoints.get('dem_smoothed'))
+
+    global_building_dem = combine_dem_rasters(dem_smoothed, building_raster)
+    if output_path:
+        write_raster(global_building_dem, output_path)
+        print(f"Combined DEM and building layers saved to {output_path}")
+    return global_building_dem
+
 
 def create_global_building_dem():
     utglobus_path = ''
@@ -13,17 +64,14 @@ def create_global_building_dem():
            "xmax": 122764.46,
            "ymax": 485845.95}
 
-    #crop and reproject the UTBLOBUS to the aoi
-    utglobus_cropped_utm = crop_reproj_vector(utglobus_path, utglobus_reproj_c_path, target_crs, bbx)
-
-    #rasterize utglobus building
     utbuilding_tif_path = ''
-    utbuilding_tif = rasterize_gpkg(utglobus_cropped_utm, utbuilding_tif_path)
-
-    #smoothing nasadem
     input_nasadem = ''
     output_nasadem_smoothed = ''
-    dem_smoothed = smooth_dem(input_nasadem, output_nasadem_smoothed, sigma=1)
-
     output_global_building_dem = ''
-    combine_dem_and_building(dem_smoothed, utbuilding_tif_path, output_global_building_dem)
\ No newline at end of file
+
+    # Intermediate layers are only written when a checkpoint path is set
+    checkpoints = {'buildings': utglobus_reproj_c_path,
+                   'building_raster': utbuilding_tif_path,
+                   'dem_smoothed': output_nasadem_smoothed}
+    return build_global_building_dem(utglobus_path, input_nasadem, bbx, output_global_building_dem, target_crs,
+                                      sigma=1, checkpoints=checkpoints)
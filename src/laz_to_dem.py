@@ -1,3 +1,8 @@
+import glob
+import math
+import multiprocessing
+import os
+
 import laspy
 import numpy as np
 import rasterio
@@ -7,6 +12,9 @@ from concurrent.futures import ProcessPoolExecutor
 
 from rasterio.enums import Resampling
 from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from lidar_grid import grid_max, group_by_cell, lattice_from_bounds, cell_index, iter_points_in_bbox, StatisticsGrid
 
 
 def las_to_tif_with_filter(las_file_path, output_tif_path, classifications, bbox = [120764.45790837877, 485845.9530135797, 122764.4639352827, 487845.9552846286], resolution=1):
@@ -40,17 +48,15 @@ def las_to_tif_with_filter(las_file_path, output_tif_path, classifications, bbox
         width = int(np.ceil((max_x - min_x) / resolution))
         height = int(np.ceil((max_y - min_y) / resolution))
 
-        # Create an empty grid
-        grid = np.full((height, width), np.nan, dtype=np.float32)
+        # Row/column of every point at once (truncation, as int() did per point)
+        cols = ((filtered_x - min_x) / resolution).astype(np.int64)
+        rows = ((max_y - filtered_y) / resolution).astype(np.int64)
 
-        # Fill the grid
-        for x, y, z in zip(filtered_x, filtered_y, filtered_z):
-            col = int((x - min_x) / resolution)
-            row = int((max_y - y) / resolution)
+        # Ensure indices are within bounds
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
 
-            # Ensure indices are within bounds
-            if 0 <= row < height and 0 <= col < width:
-                grid[row, col] = max(grid[row, col], z) if not np.isnan(grid[row, col]) else z
+        # Fill the grid with the highest point per cell
+        grid = grid_max(rows[inside], cols[inside], filtered_z[inside], height, width)
 
         # Define the transformation for raster coordinates
         transform = Affine.translation(min_x - resolution / 2, max_y + resolution / 2) * Affine.scale(resolution,
@@ -69,41 +75,330 @@ def las_to_tif_with_filter(las_file_path, output_tif_path, classifications, bbox
     return f"{output_tif_path} created successfully."
 
 
-tasks = [
-    {
-        "las_file_path": r"C:\Users\www\WRI-cif\Amsterdam\2023_C_25GN1.LAZ",
-        "output_tif_path": r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p1.tif",
-        "classifications": [6],
-    },
-    {
-        "las_file_path": r"C:\Users\www\WRI-cif\Amsterdam\2023_C_25EZ1.LAZ",
-        "output_tif_path": r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2_p2.tif",
-        "classifications": [6],
-    },
-    # {
-    #     "las_file_path": r"C:\Users\www\WRI-cif\Amsterdam\2023_C_25GN1.LAZ",
-    #     "output_tif_path": r"C:jk\Users\www\WRI-cif\Amsterdam\Laz_result\DEM_building_aoi2_p1.tif",
-    #     "classifications": [2, 6],
-    # },
-    # {
-    #     "las_file_path": r"C:\Users\www\WRI-cif\Amsterdam\2023_C_25EZ1.LAZ",
-    #     "output_tif_path": r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\DEM_building_aoi2_p2.tif",
-    #     "classifications": [2, 6],
-    # }
-]
-
-def process_task(task):
-    return las_to_tif_with_filter(
-        task["las_file_path"],
-        task["output_tif_path"],
-        task["classifications"]
-    )
+def las_to_tif_streaming(las_file_path, output_tif_path, classifications, bbox=[120764.45790837877, 485845.9530135797, 122764.4639352827, 487845.9552846286], resolution=1, chunk_size=2_000_000):
+    """
+    Streaming version of las_to_tif_with_filter: the tile is decompressed chunk by chunk and every chunk is
+    filtered by bbox and classification and reduced into the output grid, so peak memory is one chunk plus the grid.
+
+    The grid covers the intersection of bbox and the tile extent, snapped to multiples of the resolution
+    (instead of starting at the lowest filtered point), so rasters of neighbouring tiles share one lattice.
+    """
+    with laspy.open(las_file_path) as lasfile:
+        header = lasfile.header
+        extent = (max(bbox[0], header.mins[0]), max(bbox[1], header.mins[1]),
+                  min(bbox[2], header.maxs[0]), min(bbox[3], header.maxs[1]))
+
+    if extent[0] > extent[2] or extent[1] > extent[3]:
+        print("No points match the specified criteria.")
+        return
+
+    transform, height, width = lattice_from_bounds(extent, resolution)
+    grid = np.full((height, width), np.nan, dtype=np.float32)
+
+    num_points = 0
+    for points in iter_points_in_bbox(las_file_path, bbox, classifications, chunk_size):
+        rows, cols, inside = cell_index(np.asarray(points.x), np.asarray(points.y), transform, height, width)
+        grid_max(rows[inside], cols[inside], np.asarray(points.z)[inside], height, width, grid=grid)
+        num_points += int(inside.sum())
+
+    if num_points == 0:
+        print("No points match the specified criteria.")
+        return
+
+    with rasterio.open(
+            output_tif_path, 'w', driver='GTiff',
+            height=height, width=width,
+            count=1, dtype=str(grid.dtype),
+            crs=CRS.from_epsg(28992).to_wkt(),
+            transform=transform, nodata=np.nan
+    ) as dst:
+        dst.write(grid, 1)
+
+    return f"{output_tif_path} created successfully."
+
+
+def las_to_multi_tif(las_file_path, products, bbox=[120764.45790837877, 485845.9530135797, 122764.4639352827, 487845.9552846286], resolution=1, chunk_size=2_000_000):
+    """
+    Derives several rasters from one streaming read of a LAS/LAZ tile, instead of one read per product.
+
+    Parameters:
+    - las_file_path: path to the LAS/LAZ file.
+    - products: list of dicts, one per output file, e.g.
+        {"output_tif_path": "building.tif", "classifications": [6], "stats": ["max", "p95"]}
+        {"output_tif_path": "dem.tif", "classifications": [2, 6], "stats": ["max", "min", "mean", "count"]}
+      Every statistic becomes one band of the output file, in the given order, with the statistic as band
+      description. Supported statistics are max, min, mean, count and percentiles written as p<q> (e.g. p95).
+    - bbox: [min_x, min_y, max_x, max_y] to keep.
+    - resolution: cell size of the output rasters.
+    - chunk_size: number of points decompressed at a time.
+
+    All products share the lattice of las_to_tif_streaming (bbox intersected with the tile, snapped to the resolution).
+    """
+    with laspy.open(las_file_path) as lasfile:
+        header = lasfile.header
+        extent = (max(bbox[0], header.mins[0]), max(bbox[1], header.mins[1]),
+                  min(bbox[2], header.maxs[0]), min(bbox[3], header.maxs[1]))
+
+    if extent[0] > extent[2] or extent[1] > extent[3]:
+        print("No points match the specified criteria.")
+        return
+
+    transform, height, width = lattice_from_bounds(extent, resolution)
+    grids = [StatisticsGrid(height, width, product["stats"]) for product in products]
+
+    # Decompress only the classes that some product needs, then split the chunk per product
+    all_classes = sorted({c for product in products for c in product["classifications"]})
+    for points in iter_points_in_bbox(las_file_path, bbox, all_classes, chunk_size):
+        rows, cols, inside = cell_index(np.asarray(points.x), np.asarray(points.y), transform, height, width)
+        classification = np.asarray(points.classification)
+        z = np.asarray(points.z)
+        for product, grid in zip(products, grids):
+            mask = inside & np.isin(classification, product["classifications"])
+            grid.add(rows[mask], cols[mask], z[mask])
+
+    for product, grid in zip(products, grids):
+        bands = grid.result()
+        with rasterio.open(
+                product["output_tif_path"], 'w', driver='GTiff',
+                height=height, width=width,
+                count=len(product["stats"]), dtype='float32',
+                crs=CRS.from_epsg(28992).to_wkt(),
+                transform=transform, nodata=np.nan
+        ) as dst:
+            for band_index, stat in enumerate(product["stats"], start=1):
+                dst.write(bands[stat], band_index)
+                dst.set_band_description(band_index, stat)
+        print(f"{product['output_tif_path']} created with bands {product['stats']}")
+
+    return [product["output_tif_path"] for product in products]
+
+
+def build_laz_index(directory, patterns=('*.LAZ', '*.laz', '*.LAS', '*.las')):
+    """
+    Builds a bounds index of the LAS/LAZ tiles in a directory by reading only their headers.
+
+    Returns:
+    - list of {"las_file_path": path, "bounds": (min_x, min_y, max_x, max_y)}, one per tile.
+    """
+    paths = sorted({os.path.normpath(path) for pattern in patterns for path in glob.glob(os.path.join(directory, pattern))})
+    las_index = []
+    for path in paths:
+        with laspy.open(path) as lasfile:
+            header = lasfile.header
+            las_index.append({
+                "las_file_path": path,
+                "bounds": (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1]),
+            })
+    return las_index
+
+
+def tile_window(tile_bounds, transform, height, width):
+    """
+    Window of the mosaic grid that holds every point of a tile (cells are half-open, so a point on the upper
+    edge of the tile falls in the next cell).
+    """
+    resolution = transform.a
+    col_start = max(0, math.floor((tile_bounds[0] - transform.c) / resolution))
+    col_stop = min(width, math.floor((tile_bounds[2] - transform.c) / resolution) + 1)
+    row_start = max(0, math.floor((transform.f - tile_bounds[3]) / resolution))
+    row_stop = min(height, math.floor((transform.f - tile_bounds[1]) / resolution) + 1)
+    if col_start >= col_stop or row_start >= row_stop:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def grid_tile_window(task):
+    """
+    Worker: grids the points of one tile onto its window of the shared mosaic lattice with the per-cell max.
+    """
+    window = task["window"]
+    window_transform = rasterio.windows.transform(window, task["transform"])
+    height, width = int(window.height), int(window.width)
+    grid = np.full((height, width), np.nan, dtype=np.float32)
+
+    for points in iter_points_in_bbox(task["las_file_path"], task["bbox"], task["classifications"], task["chunk_size"]):
+        rows, cols, inside = cell_index(np.asarray(points.x), np.asarray(points.y), window_transform, height, width)
+        grid_max(rows[inside], cols[inside], np.asarray(points.z)[inside], height, width, grid=grid)
+
+    return window, grid
+
+
+def build_laz_mosaic(las_index, aoi_bounds, output_tif_path, classifications, resolution=1, max_workers=None, chunk_size=2_000_000):
+    """
+    Grids every tile of a LAS/LAZ index that intersects the AOI onto one shared lattice and writes a single raster.
+
+    The lattice covers the AOI snapped to multiples of the resolution, so there is no per-tile grid origin and no
+    separate merge step. Tiles are gridded in parallel worker processes, each on its own window of the mosaic, and
+    the windows are merged into the output with the per-cell max as they complete.
+
+    Parameters:
+    - las_index: output of build_laz_index.
+    - aoi_bounds: (min_x, min_y, max_x, max_y) of the mosaic.
+    - output_tif_path: path of the output GeoTIFF (tiled, NaN as nodata).
+    - classifications: list of classification codes to keep, e.g. [6] for buildings or [2, 6] for a DEM with buildings.
+    - resolution: cell size of the mosaic.
+    - max_workers: number of worker processes, defaults to the number of CPUs.
+    - chunk_size: number of points decompressed at a time in each worker.
+    """
+    transform, height, width = lattice_from_bounds(aoi_bounds, resolution)
+
+    tasks = []
+    for tile in las_index:
+        tile_bounds = tile["bounds"]
+        if (tile_bounds[2] < aoi_bounds[0] or tile_bounds[0] > aoi_bounds[2] or
+                tile_bounds[3] < aoi_bounds[1] or tile_bounds[1] > aoi_bounds[3]):
+            continue
+        window = tile_window(tile_bounds, transform, height, width)
+        if window is None:
+            continue
+        tasks.append({
+            "las_file_path": tile["las_file_path"],
+            "bbox": aoi_bounds,
+            "classifications": classifications,
+            "transform": transform,
+            "window": window,
+            "chunk_size": chunk_size,
+        })
+    print(f"{len(tasks)} of {len(las_index)} tiles intersect the AOI")
+
+    profile = {
+        'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+        'crs': CRS.from_epsg(28992).to_wkt(), 'transform': transform, 'nodata': np.nan,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+    }
+    written = []
+    with rasterio.open(output_tif_path, 'w+', **profile) as dst:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for window, grid in executor.map(grid_tile_window, tasks):
+                # Neighbouring tiles share the cells along their common edge
+                if any(rasterio.windows.intersect(window, other) for other in written):
+                    grid = np.fmax(grid, dst.read(1, window=window))
+                dst.write(grid, 1, window=window)
+                written.append(window)
+
+    print(f"Mosaic saved to {output_tif_path}")
+    return output_tif_path
+
+
+# Memory-mapped output grid and its row-stripe locks, opened once in every worker by _init_shared_grid
+_shared_grid = None
+_stripe_locks = None
+_stripe_rows = None
+
+
+def _init_shared_grid(grid_path, shape, stripe_locks, stripe_rows):
+    global _shared_grid, _stripe_locks, _stripe_rows
+    _shared_grid = np.memmap(grid_path, dtype=np.float32, mode='r+', shape=shape)
+    _stripe_locks = stripe_locks
+    _stripe_rows = stripe_rows
+
+
+def reduce_into_shared_grid(task):
+    """
+    Worker: grids a tile (or a range of its points) and reduces every chunk straight into the shared
+    memory-mapped grid with the per-cell max. Only the row stripes touched by a chunk are locked while it is merged,
+    so workers on different tiles do not wait for each other and no array is sent back to the parent.
+    """
+    transform = task["transform"]
+    height, width = _shared_grid.shape
+    flat_grid = _shared_grid.reshape(-1)
+    num_points = 0
+
+    for points in iter_points_in_bbox(task["las_file_path"], task["bbox"], task["classifications"],
+                                      task["chunk_size"], task["start"], task["stop"]):
+        rows, cols, inside = cell_index(np.asarray(points.x), np.asarray(points.y), transform, height, width)
+        if not inside.any():
+            continue
+        cells, starts, sorted_z = group_by_cell(rows[inside], cols[inside], np.asarray(points.z)[inside], width)
+        cell_max = np.maximum.reduceat(sorted_z, starts).astype(np.float32)
+        num_points += int(inside.sum())
+
+        # Cells are sorted, so each stripe is one contiguous slice of them
+        stripes = cells // (width * _stripe_rows)
+        bounds = np.flatnonzero(np.r_[True, stripes[1:] != stripes[:-1], True])
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            stripe_cells = cells[first:last]
+            with _stripe_locks[stripes[first]]:
+                flat_grid[stripe_cells] = np.fmax(flat_grid[stripe_cells], cell_max[first:last])
+
+    _shared_grid.flush()
+    return num_points
+
+
+def build_laz_mosaic_shared(las_index, aoi_bounds, output_tif_path, classifications, resolution=1, max_workers=None,
+                            chunk_size=2_000_000, points_per_task=None, grid_path=None, num_stripes=64):
+    """
+    Variant of build_laz_mosaic in which the output grid lives in one memory-mapped file shared by all workers.
+    Workers reduce their points into it directly (per-cell max, guarded by row-stripe locks) instead of returning
+    window arrays to the parent, so large AOIs can be gridded with all cores without N copies of the grid in memory.
+
+    Parameters (in addition to build_laz_mosaic):
+    - points_per_task: if set, every tile is split into ranges of this many points, so that a few large tiles can
+      still keep all workers busy.
+    - grid_path: path of the temporary memory-mapped grid, defaults to the output path with a .grid suffix.
+    - num_stripes: number of row stripes (and locks) the grid is divided into.
+    """
+    transform, height, width = lattice_from_bounds(aoi_bounds, resolution)
+    grid_path = grid_path or output_tif_path + '.grid'
+
+    tasks = []
+    for tile in las_index:
+        tile_bounds = tile["bounds"]
+        if (tile_bounds[2] < aoi_bounds[0] or tile_bounds[0] > aoi_bounds[2] or
+                tile_bounds[3] < aoi_bounds[1] or tile_bounds[1] > aoi_bounds[3]):
+            continue
+        with laspy.open(tile["las_file_path"]) as lasfile:
+            point_count = lasfile.header.point_count
+        step = points_per_task or point_count
+        for start in range(0, point_count, max(1, step)):
+            tasks.append({
+                "las_file_path": tile["las_file_path"],
+                "bbox": aoi_bounds,
+                "classifications": classifications,
+                "transform": transform,
+                "chunk_size": chunk_size,
+                "start": start,
+                "stop": start + step,
+            })
+    print(f"{len(tasks)} tasks over the tiles that intersect the AOI")
+
+    # Create the shared grid on disk, filled with NaN stripe by stripe
+    stripe_rows = max(1, math.ceil(height / num_stripes))
+    grid = np.memmap(grid_path, dtype=np.float32, mode='w+', shape=(height, width))
+    for row in range(0, height, stripe_rows):
+        grid[row:row + stripe_rows] = np.nan
+    grid.flush()
+
+    stripe_locks = [multiprocessing.Lock() for _ in range(math.ceil(height / stripe_rows))]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_shared_grid,
+                             initargs=(grid_path, (height, width), stripe_locks, stripe_rows)) as executor:
+        num_points = sum(executor.map(reduce_into_shared_grid, tasks))
+    print(f"Gridded {num_points} points")
+
+    profile = {
+        'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+        'crs': CRS.from_epsg(28992).to_wkt(), 'transform': transform, 'nodata': np.nan,
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate',
+    }
+    with rasterio.open(output_tif_path, 'w', **profile) as dst:
+        for row in range(0, height, stripe_rows):
+            rows = min(stripe_rows, height - row)
+            dst.write(np.asarray(grid[row:row + rows]), 1, window=Window(0, row, width, rows))
+
+    del grid
+    os.remove(grid_path)
+    print(f"Mosaic saved to {output_tif_path}")
+    return output_tif_path
 
 
 if __name__ == "__main__":
-    with ProcessPoolExecutor() as executor:
-        # Run tasks in parallel using the helper function
-        results = list(executor.map(process_task, tasks))
+    las_index = build_laz_index(r"C:\Users\www\WRI-cif\Amsterdam")
+    build_laz_mosaic(
+        las_index,
+        aoi_bounds=[120764.45790837877, 485845.9530135797, 122764.4639352827, 487845.9552846286],
+        output_tif_path=r"C:\Users\www\WRI-cif\Amsterdam\Laz_result\building_aoi2.tif",
+        classifications=[6],
+    )
 
 # def laz_to_tif(input_path, output_path, resolution = 1):
 #
@@ -189,19 +484,14 @@ def process_laz_to_tif(las_file_path, output_tif_path, resolution=1):
         width = int((max_x - min_x) // resolution)
         height = int((max_y - min_y) // resolution)
 
-        grid = np.full((height, width), np.nan, dtype=np.float32)
-
-        for x, y, z in zip(x, y, z):
-            col = int((x - min_x) // resolution)
-            row = int((max_y - y) // resolution)
+        cols = np.floor_divide(x - min_x, resolution).astype(np.int64)
+        rows = np.floor_divide(max_y - y, resolution).astype(np.int64)
 
-            # Ensure that the indices are within the array bounds
-            if row >= height:
-                row = height - 1
-            if col >= width:
-                col = width - 1
+        # Ensure that the indices are within the array bounds
+        rows = np.minimum(rows, height - 1)
+        cols = np.minimum(cols, width - 1)
 
-            grid[row, col] = max(grid[row, col], z) if not np.isnan(grid[row, col]) else z
+        grid = grid_max(rows, cols, z, height, width)
 
         # Define the transformation for raster coordinates
         transform = Affine.translation(min_x - resolution / 2, max_y + resolution / 2) * Affine.scale(resolution,
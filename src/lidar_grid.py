@@ -0,0 +1,421 @@
+import math
+import os
+import tempfile
+
+import laspy
+import numpy as np
+from rasterio.transform import from_origin
+
+
+def group_by_cell(rows, cols, values, width):
+    """
+    Sorts point values by their flat cell index so that every occupied cell is one contiguous run.
+
+    Parameters:
+    - rows, cols: integer row/column index of every point (already inside the grid).
+    - values: value of every point (e.g. z).
+    - width: number of columns of the grid.
+
+    Returns:
+    - cells: flat index of every occupied cell.
+    - starts: start of the run of each occupied cell in sorted_values.
+    - sorted_values: values ordered by cell.
+    """
+    flat = rows.astype(np.int64) * width + cols.astype(np.int64)
+    order = np.argsort(flat, kind='stable')
+    flat = flat[order]
+    starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]]) if len(flat) else np.empty(0, dtype=np.int64)
+    return flat[starts], starts, values[order]
+
+
+def grid_max(rows, cols, z, height, width, grid=None):
+    """
+    Grids points to the maximum z per cell with one sort-and-reduce instead of a Python loop over points.
+
+    Parameters:
+    - rows, cols: integer row/column index of every point (already inside the grid).
+    - z: height of every point.
+    - height, width: shape of the grid.
+    - grid: optional float32 grid to merge into (e.g. the grid of a previous chunk); cells keep the larger value.
+
+    Returns:
+    - float32 grid of shape (height, width), NaN where no point fell.
+    """
+    if grid is None:
+        grid = np.full((height, width), np.nan, dtype=np.float32)
+    if len(z) == 0:
+        return grid
+
+    cells, starts, sorted_z = group_by_cell(rows, cols, z, width)
+    cell_max = np.maximum.reduceat(sorted_z, starts).astype(np.float32)
+
+    flat_grid = grid.reshape(-1)
+    flat_grid[cells] = np.fmax(flat_grid[cells], cell_max)  # fmax ignores the NaN of empty cells
+    return grid
+
+
+def lattice_from_bounds(bounds, resolution):
+    """
+    Defines a north-up grid covering bounds whose edges are snapped to multiples of the resolution,
+    so that grids built from different tiles or AOIs share one pixel lattice.
+
+    Parameters:
+    - bounds: (min_x, min_y, max_x, max_y).
+    - resolution: cell size in CRS units.
+
+    Returns:
+    - transform, height, width of the grid.
+    """
+    min_x = math.floor(bounds[0] / resolution) * resolution
+    min_y = math.floor(bounds[1] / resolution) * resolution
+    max_x = math.ceil(bounds[2] / resolution) * resolution
+    max_y = math.ceil(bounds[3] / resolution) * resolution
+    width = max(1, int(round((max_x - min_x) / resolution)))
+    height = max(1, int(round((max_y - min_y) / resolution)))
+    return from_origin(min_x, max_y, resolution, resolution), height, width
+
+
+def cell_index(x, y, transform, height, width):
+    """
+    Row/column of every point in a north-up grid.
+    Cells are half-open, except that the last column and row also hold the points lying exactly on the right and
+    bottom edge of the grid (as the closing bin of np.histogram2d), so points on the lattice max-x / min-y are kept.
+
+    Returns:
+    - rows, cols: integer cell index of every point.
+    - inside: boolean mask of the points that fall inside the grid.
+    """
+    col_positions = (np.asarray(x) - transform.c) / transform.a
+    row_positions = (np.asarray(y) - transform.f) / transform.e
+    cols = np.floor(col_positions).astype(np.int64)
+    rows = np.floor(row_positions).astype(np.int64)
+    cols[col_positions == width] = width - 1
+    rows[row_positions == height] = height - 1
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return rows, cols, inside
+
+
+def iter_points_in_bbox(las_file_path, bbox=None, classifications=None, chunk_size=2_000_000, start=0, stop=None):
+    """
+    Streams the points of a LAS/LAZ file chunk by chunk, keeping only those inside bbox and (optionally) in
+    the given classifications, so peak memory stays at one chunk instead of the whole tile.
+    Files and chunks whose points all fall outside bbox are skipped without further processing.
+
+    Parameters:
+    - las_file_path: path to the LAS/LAZ file.
+    - bbox: (min_x, min_y, max_x, max_y), or None to keep every point.
+    - classifications: list of classification codes to keep, or None to keep all classes.
+    - chunk_size: number of points decompressed at a time.
+    - start, stop: optional range of point indices to read, so that one tile can be split across workers.
+
+    Yields:
+    - filtered point records (laspy ScaleAwarePointRecord) of each chunk that has points left.
+    """
+    with laspy.open(las_file_path) as lasfile:
+        header = lasfile.header
+        if bbox is not None and (header.maxs[0] < bbox[0] or header.mins[0] > bbox[2] or
+                                 header.maxs[1] < bbox[1] or header.mins[1] > bbox[3]):
+            return
+
+        stop = header.point_count if stop is None else min(stop, header.point_count)
+        if start:
+            lasfile.seek(start)
+        remaining = stop - start
+
+        while remaining > 0:
+            points = lasfile.read_points(min(chunk_size, remaining))
+            if len(points) == 0:
+                break
+            remaining -= len(points)
+
+            mask = np.ones(len(points), dtype=bool)
+            if bbox is not None:
+                x = np.asarray(points.x)
+                if x.max() < bbox[0] or x.min() > bbox[2]:
+                    continue
+                y = np.asarray(points.y)
+                if y.max() < bbox[1] or y.min() > bbox[3]:
+                    continue
+                mask &= (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+            if classifications is not None:
+                mask &= np.isin(np.asarray(points.classification), classifications)
+
+            if mask.any():
+                yield points[mask]
+
+
+class StatisticsGrid:
+    """
+    Accumulates several per-cell statistics of points that arrive in chunks, so that one read of a tile can
+    produce every product derived from it.
+
+    Supported statistics: 'max', 'min', 'mean', 'count' and percentiles written as 'p<q>' (e.g. 'p95').
+    Max/min/mean/count are reduced chunk by chunk. Percentiles cannot be merged from per-chunk summaries, so the
+    (cell, z) pairs of the selected points are kept per stripe of stripe_rows grid rows; once more than
+    max_buffered_points are held in memory they are appended to temporary files, and result() computes the
+    percentiles one stripe at a time. Memory is bounded by max_buffered_points and the points of one stripe.
+    """
+
+    def __init__(self, height, width, stats=('max',), stripe_rows=256, max_buffered_points=5_000_000):
+        self.height = height
+        self.width = width
+        self.stats = list(stats)
+        for stat in self.stats:
+            if stat not in ('max', 'min', 'mean', 'count') and not (stat.startswith('p') and _is_number(stat[1:])):
+                raise ValueError(f"Unknown statistic '{stat}', expected max, min, mean, count or p<q>.")
+
+        size = height * width
+        self.max = np.full(size, np.nan, dtype=np.float32) if 'max' in self.stats else None
+        self.min = np.full(size, np.nan, dtype=np.float32) if 'min' in self.stats else None
+        self.sum = np.zeros(size, dtype=np.float64) if 'mean' in self.stats else None
+        self.count = np.zeros(size, dtype=np.int64)
+
+        self.percentiles = [stat for stat in self.stats if stat.startswith('p')]
+        self.stripe_cells = stripe_rows * width
+        self.n_stripes = math.ceil(height / stripe_rows)
+        self.max_buffered_points = max_buffered_points
+        self.buffers = {}
+        self.buffered_points = 0
+        self.spill_dir = None
+
+    def add(self, rows, cols, z):
+        """Adds points given by their row/column inside the grid and their height."""
+        if len(z) == 0:
+            return
+        cells, starts, sorted_z = group_by_cell(rows, cols, np.asarray(z, dtype=np.float64), self.width)
+
+        self.count[cells] += np.diff(np.r_[starts, len(sorted_z)])
+        if self.max is not None:
+            self.max[cells] = np.fmax(self.max[cells], np.maximum.reduceat(sorted_z, starts).astype(np.float32))
+        if self.min is not None:
+            self.min[cells] = np.fmin(self.min[cells], np.minimum.reduceat(sorted_z, starts).astype(np.float32))
+        if self.sum is not None:
+            self.sum[cells] += np.add.reduceat(sorted_z, starts)
+        if self.percentiles:
+            self._buffer(np.repeat(cells, np.diff(np.r_[starts, len(sorted_z)])), sorted_z.astype(np.float32))
+
+    def _buffer(self, point_cells, values):
+        # The points are sorted by cell, so every stripe is one slice
+        stripes = point_cells // self.stripe_cells
+        bounds = np.searchsorted(stripes, np.arange(self.n_stripes + 1))
+        for stripe in np.unique(stripes):
+            part = slice(bounds[stripe], bounds[stripe + 1])
+            self.buffers.setdefault(int(stripe), []).append((point_cells[part], values[part]))
+        self.buffered_points += len(values)
+        if self.buffered_points > self.max_buffered_points:
+            self._spill()
+
+    def _stripe_files(self, stripe):
+        return (os.path.join(self.spill_dir.name, f"{stripe}.cells"),
+                os.path.join(self.spill_dir.name, f"{stripe}.values"))
+
+    def _spill(self):
+        # Appends the buffered pairs of every stripe to its temporary files
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(prefix='statistics_grid_')
+        for stripe, parts in self.buffers.items():
+            cells_path, values_path = self._stripe_files(stripe)
+            with open(cells_path, 'ab') as cells_file, open(values_path, 'ab') as values_file:
+                for point_cells, values in parts:
+                    point_cells.astype(np.int64).tofile(cells_file)
+                    values.astype(np.float32).tofile(values_file)
+        self.buffers = {}
+        self.buffered_points = 0
+
+    def _stripe_points(self, stripe):
+        parts = list(self.buffers.pop(stripe, []))
+        if self.spill_dir is not None:
+            cells_path, values_path = self._stripe_files(stripe)
+            if os.path.exists(cells_path):
+                parts.append((np.fromfile(cells_path, dtype=np.int64), np.fromfile(values_path, dtype=np.float32)))
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate([cells for cells, _ in parts]), np.concatenate([values for _, values in parts])
+
+    def _percentile_grids(self):
+        grids = {stat: np.full(self.count.shape, np.nan, dtype=np.float32) for stat in self.percentiles}
+        for stripe in range(self.n_stripes):
+            cells, values = self._stripe_points(stripe)
+            if len(cells) == 0:
+                continue
+            order = np.lexsort((values, cells))
+            cells, values = cells[order], values[order]
+            starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+            counts = np.diff(np.r_[starts, len(cells)])
+            for stat in self.percentiles:
+                # Linear interpolation between the closest ranks, as np.percentile does
+                position = float(stat[1:]) / 100 * (counts - 1)
+                lower = np.floor(position).astype(np.int64)
+                upper = np.ceil(position).astype(np.int64)
+                fraction = position - lower
+                low_values = values[starts + lower].astype(np.float64)
+                high_values = values[starts + upper].astype(np.float64)
+                grids[stat][cells[starts]] = low_values + (high_values - low_values) * fraction
+
+        self.buffered_points = 0
+        if self.spill_dir is not None:
+            self.spill_dir.cleanup()
+            self.spill_dir = None
+        return grids
+
+    def result(self):
+        """
+        Returns a dict of float32 grids of shape (height, width), one per statistic, NaN where no point fell.
+        Percentiles can only be computed once, because their points are released on the way.
+        """
+        grids = {}
+        empty = self.count == 0
+        percentile_grids = self._percentile_grids() if self.percentiles else {}
+
+        for stat in self.stats:
+            if stat == 'max':
+                grid = self.max
+            elif stat == 'min':
+                grid = self.min
+            elif stat == 'count':
+                grid = self.count.astype(np.float32)
+            elif stat == 'mean':
+                grid = np.full(self.count.shape, np.nan, dtype=np.float32)
+                grid[~empty] = self.sum[~empty] / self.count[~empty]
+            else:
+                grid = percentile_grids[stat]
+            grids[stat] = grid.reshape(self.height, self.width)
+        return grids
+
+
+def thin_indices(x, y, z, cell_size=0.5, keep='highest', voxel=False, priority=None):
+    """
+    Keeps one point per 2D cell (or 3D voxel) with one sort instead of a loop over cells.
+
+    Parameters:
+    - x, y, z: coordinates of the points.
+    - cell_size: edge length of the cells; cells are aligned to multiples of cell_size, so results of different
+      chunks or tiles refer to the same cells, and cells nest in raster cells whose size is a multiple of it.
+    - keep: 'highest', 'lowest' or 'random' point of every cell.
+    - voxel: thin in 3D voxels instead of 2D cells.
+    - priority: random values used for keep='random' (one per point); drawn here if None.
+
+    Returns:
+    - sorted indices of the kept points.
+    """
+    if keep not in ('highest', 'lowest', 'random'):
+        raise ValueError(f"Unknown thinning rule '{keep}', expected highest, lowest or random.")
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # y is counted downwards, so that cells split at the same edges as the rows of a north-up raster (see cell_index)
+    axes = [np.asarray(x), -np.asarray(y), np.asarray(z)] if voxel else [np.asarray(x), -np.asarray(y)]
+    cells = [np.floor(axis / cell_size).astype(np.int64) for axis in axes]
+    flat = np.ravel_multi_index(tuple(cell - cell.min() for cell in cells), tuple(int(cell.max() - cell.min()) + 1
+                                                                              for cell in cells))
+
+    if keep == 'random':
+        values = np.random.default_rng().random(len(x)) if priority is None else priority
+    else:
+        values = np.asarray(z) if keep == 'highest' else -np.asarray(z)
+
+    # Within every cell the kept point comes last
+    order = np.lexsort((values, flat))
+    last = np.flatnonzero(np.r_[flat[order][1:] != flat[order][:-1], True])
+    return np.sort(order[last])
+
+
+class PointThinner:
+    """
+    Thins points that arrive in chunks to one point per cell.
+
+    Every chunk is thinned on its own and only its kept points are held; result() thins them once more, which gives
+    the same points as thinning the whole cloud at once, because the best point of a cell is the best of the points
+    kept for it by the chunks.
+    """
+
+    def __init__(self, cell_size=0.5, keep='highest', voxel=False, seed=None):
+        self.cell_size = cell_size
+        self.keep = keep
+        self.voxel = voxel
+        self.rng = np.random.default_rng(seed)
+        self.chunks = []
+        self.priorities = []
+        self.points_in = 0
+
+    def add(self, points):
+        """Adds a laspy point record (e.g. a chunk of iter_points_in_bbox)."""
+        if len(points) == 0:
+            return
+        self.points_in += len(points)
+        priority = self.rng.random(len(points)) if self.keep == 'random' else None
+        kept = thin_indices(np.asarray(points.x), np.asarray(points.y), np.asarray(points.z), self.cell_size,
+                            self.keep, self.voxel, priority)
+        self.chunks.append(points[kept])
+        if priority is not None:
+            self.priorities.append(priority[kept])
+
+    def result(self):
+        """Returns the thinned points as one laspy point record, or None if no point was added."""
+        if not self.chunks:
+            return None
+        first = self.chunks[0]
+        points = laspy.ScaleAwarePointRecord(np.concatenate([chunk.array for chunk in self.chunks]),
+                                             first.point_format, first.scales, first.offsets)
+        priority = np.concatenate(self.priorities) if self.priorities else None
+        kept = thin_indices(np.asarray(points.x), np.asarray(points.y), np.asarray(points.z), self.cell_size,
+                            self.keep, self.voxel, priority)
+        print(f"Thinned {self.points_in} points to {len(kept)} ({self.points_in / max(len(kept), 1):.1f}x fewer)")
+        return points[kept]
+
+
+def thinning_report(las_file_path, cell_size=0.5, keep='highest', voxel=False, resolution=1, bbox=None,
+                    classifications=None, chunk_size=2_000_000):
+    """
+    Reports how much thinning changes a max-height raster of a LAS/LAZ file: point reduction and the cell
+    differences between the grids of all points and of the thinned points.
+
+    With keep='highest', 2D cells and a resolution that is a multiple of cell_size, the max grid does not change.
+
+    Returns:
+    - dict with points_in, points_kept, reduction, changed_cells, max_abs_diff and mean_abs_diff.
+    """
+    with laspy.open(las_file_path) as lasfile:
+        header = lasfile.header
+        bounds = bbox if bbox is not None else (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+    transform, height, width = lattice_from_bounds(bounds, resolution)
+
+    full = np.full((height, width), np.nan, dtype=np.float32)
+    thinner = PointThinner(cell_size, keep, voxel)
+    for points in iter_points_in_bbox(las_file_path, bbox, classifications, chunk_size):
+        rows, cols, inside = cell_index(np.asarray(points.x), np.asarray(points.y), transform, height, width)
+        grid_max(rows[inside], cols[inside], np.asarray(points.z)[inside], height, width, grid=full)
+        thinner.add(points)
+
+    thinned = np.full((height, width), np.nan, dtype=np.float32)
+    kept_points = thinner.result()
+    points_kept = 0
+    if kept_points is not None:
+        points_kept = len(kept_points)
+        rows, cols, inside = cell_index(np.asarray(kept_points.x), np.asarray(kept_points.y), transform, height,
+                                        width)
+        grid_max(rows[inside], cols[inside], np.asarray(kept_points.z)[inside], height, width, grid=thinned)
+
+    occupied = ~np.isnan(full)
+    lost = occupied & np.isnan(thinned)
+    difference = np.abs(full - thinned)[occupied & ~lost]
+    changed = int(lost.sum()) + int((difference > 0).sum())
+    report = {
+        "points_in": thinner.points_in,
+        "points_kept": points_kept,
+        "reduction": thinner.points_in / max(points_kept, 1),
+        "changed_cells": changed,
+        "max_abs_diff": float(difference.max()) if difference.size else 0.0,
+        "mean_abs_diff": float(difference.mean()) if difference.size else 0.0,
+    }
+    print(f"Thinning to {cell_size} m cells ({keep}): {report['reduction']:.1f}x fewer points, "
+          f"{report['changed_cells']} of {int(occupied.sum())} cells changed, "
+          f"max abs difference {report['max_abs_diff']:.3f}")
+    return report
+
+
+def _is_number(text):
+    try:
+        return 0 <= float(text) <= 100
+    except ValueError:
+        return False
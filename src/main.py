@@ -1,9 +1,53 @@
-from pre_processing_new import preprocessing
+import geopandas as gpd
+
+from pre_processing_new import preprocessing, get_bbx_and_crs, reproject_crop_raster, reproject_crop_vector
 from processing import process_buildings
+from tiled_processing import process_buildings_tiled
+from streaming_processing import process_buildings_streaming
+from raster_io import in_memory_raster, read_raster, write_raster
+from result_cache import ResultCache
+import pre_processing_new
+import processing
+import streaming_processing
+import tiled_processing
+import vector_io
+
+
+def cached_preprocessing(cache, aoi_path, raster_path, vector_path):
+    '''
+    Same as preprocessing, with the cropped raster and the cropped vector cached as separate stages, so that
+    a changed DSM only re-crops the raster and a changed building file only re-crops the vector.
+
+    :return: the paths of the cached cropped raster (GeoTIFF) and cropped vector (GeoPackage)
+    '''
+    def crop_raster_to(path):
+        bbx, crs = get_bbx_and_crs(aoi_path)
+        cropped_raster, transform, nodata_value = reproject_crop_raster(raster_path, bbx, crs)
+        write_raster(in_memory_raster(cropped_raster[0], transform, crs, nodata_value), path)
+
+    def crop_vector_to(path):
+        bbx, crs = get_bbx_and_crs(aoi_path)
+        # The index is written as a column, so that building ids without an 'id' column survive the cache
+        cropped_vector = reproject_crop_vector(vector_path, bbx, crs).rename_axis('index')
+        cropped_vector.to_file(path, driver='GPKG', index=True)
 
-def main():
+    cropped_raster_path = cache.cached_file('crop_raster', crop_raster_to, inputs=[aoi_path, raster_path],
+                                            code=[crop_raster_to, pre_processing_new])
+    cropped_vector_path = cache.cached_file('crop_vector', crop_vector_to, inputs=[aoi_path, vector_path],
+                                            code=[crop_vector_to, pre_processing_new, vector_io], suffix='.gpkg')
+    return cropped_raster_path, cropped_vector_path
+
+
+def read_cropped_vector(path):
+    '''Reads a cropped vector written by cached_preprocessing, restoring its original index.'''
+    return gpd.read_file(path).set_index('index').rename_axis(None)
+
+def main(tiled=False, tile_size=1000, max_workers=None, streaming=False, cache_dir=None):
     '''
     input path from s3
+
+    :param cache_dir: optional directory of a result cache; the cropped raster, the cropped vector and the building
+        stats are then cached as separate stages, each recomputed only when its inputs, parameters or code changed
     '''
     # vector_path = r"C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\___Amsterdam\UTGLOBUS_Amsterdam.gpkg"
     # raster_path = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\ams_aoi1_building_dsm.tif'
@@ -22,11 +66,46 @@ def main():
     output_csv_path = r"C:\Users\zhuoyue.wang\Documents\Building_height_Monterrey\test\mty_ut_test.csv"
     output_vector_path = r"C:\Users\zhuoyue.wang\Documents\Building_height_Monterrey\test\mty_test.GPKG"
 
-    # preprocessing
-    cropped_raster, transform, nodata_value, cropped_vector = preprocessing(aoi_path, raster_path, vector_path)
+    def compute_building_stats():
+        if tiled:
+            # Split the AOI into tiles and process them in parallel worker processes (full-city runs)
+            building_stats, avg_diff, stddev_diff, updated_vector = process_buildings_tiled(aoi_path, raster_path, vector_path, output_csv_path, output_vector_path, tile_size=tile_size, max_workers=max_workers)
+        elif streaming:
+            # Read small DSM windows around the buildings instead of the whole AOI (country-scale DSMs)
+            building_stats, avg_diff, stddev_diff, updated_vector = process_buildings_streaming(aoi_path, raster_path, vector_path, output_csv_path, output_vector_path)
+        else:
+            # preprocessing
+            cropped_raster, transform, nodata_value, cropped_vector = preprocessing(aoi_path, raster_path, vector_path)
+
+            # Process each building in the cropped vector data
+            building_stats, avg_diff, stddev_diff, updated_vector = process_buildings(cropped_raster, cropped_vector, transform, nodata_value, output_csv_path, output_vector_path, method='zonal')
+        return building_stats, avg_diff, stddev_diff, updated_vector
+
+    if cache_dir and not (tiled or streaming):
+        cache = ResultCache(cache_dir)
+        cropped_raster_path, cropped_vector_path = cached_preprocessing(cache, aoi_path, raster_path, vector_path)
+
+        def compute_cached_building_stats():
+            cropped_raster = read_raster(cropped_raster_path)
+            return process_buildings(cropped_raster["data"], read_cropped_vector(cropped_vector_path),
+                                     cropped_raster["transform"], cropped_raster["nodata"], output_csv_path,
+                                     output_vector_path, method='zonal')
 
-    # Process each building in the cropped vector data
-    building_stats, avg_diff, stddev_diff, updated_vector = process_buildings(cropped_raster, cropped_vector, transform, nodata_value, output_csv_path, output_vector_path)
+        # Keyed on the cached crops, so only the stats are recomputed when only the processing code changed
+        building_stats, avg_diff, stddev_diff, updated_vector = cache.cached_value(
+            'building_stats', compute_cached_building_stats, inputs=[cropped_raster_path, cropped_vector_path],
+            code=[compute_cached_building_stats, read_cropped_vector, processing],
+            outputs=[output_csv_path, output_vector_path])
+    elif cache_dir:
+        # The tiled and streaming runs crop per tile/window, so they are cached as a single stage
+        cache = ResultCache(cache_dir)
+        building_stats, avg_diff, stddev_diff, updated_vector = cache.cached_value(
+            'building_stats', compute_building_stats, inputs=[aoi_path, raster_path, vector_path],
+            params={"tiled": tiled, "tile_size": tile_size, "streaming": streaming},
+            code=[pre_processing_new, processing, tiled_processing, streaming_processing, vector_io],
+            outputs=[output_csv_path, output_vector_path])
+    else:
+        building_stats, avg_diff, stddev_diff, updated_vector = compute_building_stats()
 
     # # Display the results
     # print("Building Statistics:")
@@ -1,10 +1,15 @@
+import math
 import geopandas as gpd
 import rasterio
-from rasterio.windows import from_bounds
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.windows import from_bounds, Window
+from rasterio.warp import calculate_default_transform, Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
 from shapely.geometry import box
 from rasterio.crs import CRS
 
+from vector_io import read_vector_in_bbox
+
 def get_bbx_and_crs(input_aoi_vector):
     '''
 
@@ -19,49 +24,97 @@ def get_bbx_and_crs(input_aoi_vector):
     return bbx, crs
 
 
-def reproject_crop_raster(raster_path, bbx, target_crs):
-    with rasterio.open(raster_path) as src:
-        src_crs = src.crs
-        if not src_crs:
-            src_crs = CRS.from_epsg(7415)  # Assuming 7415 is the EPSG you're starting from, adjust as necessary
+def snap_window(window, width, height):
+    '''
+    Rounds a fractional window outwards to whole pixels and clips it to the raster extent, so that the
+    transform of the window stays on the pixel lattice of the source raster.
+    '''
+    col_start = max(0, math.floor(window.col_off))
+    row_start = max(0, math.floor(window.row_off))
+    col_stop = min(width, math.ceil(window.col_off + window.width))
+    row_stop = min(height, math.ceil(window.row_off + window.height))
+    return Window(col_start, row_start, max(0, col_stop - col_start), max(0, row_stop - row_start))
+
+
+def open_warped_aoi(src, bbx, target_crs, src_crs=None, resolution=None, resampling=Resampling.nearest,
+                    tolerance=1e-6):
+    '''
+    Opens a virtual warped view of src in target_crs that only covers the AOI bounding box.
+    Nothing is reprojected until the view is read, and reads (whole or windowed) only warp the requested pixels.
+
+    :param bbx: AOI bounding box (minx, miny, maxx, maxy) in target_crs
+    :param src_crs: CRS to assume for the source, overriding the one stored in the file
+    :param resolution: output pixel size in target_crs units, defaults to the native resolution after reprojection
+    :param tolerance: error threshold of the approximate transformer in pixels; GDAL's default (0.125) makes the
+        source pixel of a cell depend on the window that is read, so tiles and blocks would not match a full read
+    :return: a rasterio WarpedVRT, to be used as a context manager
+    '''
+    src_crs = src_crs or src.crs
+    if resolution is None:
+        default_transform, _, _ = calculate_default_transform(
+            src_crs, target_crs, src.width, src.height, *src.bounds)
+        resolution = default_transform.a
+
+    # Snap the AOI to multiples of the resolution so that crops of different AOIs share one pixel lattice
+    minx = math.floor(bbx[0] / resolution) * resolution
+    maxy = math.ceil(bbx[3] / resolution) * resolution
+    width = max(1, math.ceil((bbx[2] - minx) / resolution))
+    height = max(1, math.ceil((maxy - bbx[1]) / resolution))
+
+    return WarpedVRT(src, src_crs=src_crs, crs=target_crs, resampling=resampling, tolerance=tolerance,
+                     transform=from_origin(minx, maxy, resolution, resolution), width=width, height=height)
+
+
+def resolve_crs(src, target_crs):
+    '''
+    :return: the CRS of the open raster src (EPSG:7415 if it has none) and target_crs (EPSG:28992 if None),
+        both as rasterio CRS objects
+    '''
+    src_crs = src.crs
+    if not src_crs:
+        src_crs = CRS.from_epsg(7415)  # Assuming 7415 is the EPSG you're starting from, adjust as necessary
 
-        target_crs = CRS.from_epsg(28992)  # Ensure using CRS object
+    if not target_crs:
+        target_crs = CRS.from_epsg(28992)
+    return src_crs, CRS.from_user_input(target_crs)  # Ensure using CRS object
+
+
+def describe_reprojection(src_crs, target_crs):
+    if src_crs == target_crs:
+        print("Source CRS matches the target CRS. No reprojection needed.")
+    else:
+        print(f"Reprojecting the AOI window from {src_crs} to {target_crs}.")
+
+
+def reproject_crop_raster(raster_path, bbx, target_crs, resolution=None, verbose=True):
+    '''
+    :param verbose: print whether the raster is reprojected; workers that crop many tiles pass False
+    '''
+    with rasterio.open(raster_path) as src:
+        src_crs, target_crs = resolve_crs(src, target_crs)
+        if verbose:
+            describe_reprojection(src_crs, target_crs)
 
         # Check if the source CRS matches the target CRS
         if src_crs == target_crs:
-            print("Source CRS matches the target CRS. No reprojection needed.")
             # Calculate the window without changing the CRS
-            window = from_bounds(*bbx, src.transform)
+            window = snap_window(from_bounds(*bbx, src.transform), src.width, src.height)
             cropped_data = src.read(window=window, resampling=Resampling.nearest)
             new_transform = src.window_transform(window)
             return cropped_data, new_transform, src.nodata
         else:
-            # Calculate the transform, width, and height for the reprojected raster
-            transform, width, height = calculate_default_transform(
-                src_crs, target_crs, src.width, src.height, *src.bounds)
-
-            # Set up metadata for the new raster
-            profile = src.profile
-            profile.update({
-                'crs': target_crs,
-                'transform': transform,
-                'width': width,
-                'height': height
-            })
-
-            # Prepare a window for the cropping area based on the bounding box
-            window = from_bounds(*bbx, transform)
-
-            # Reproject and read the data within the window
-            cropped_data = src.read(window=window, resampling=Resampling.nearest)
-            new_transform = src.window_transform(window)
-
-            return cropped_data, new_transform, src.nodata
+            # Warp only the AOI window into the target CRS, without materializing the full reprojected raster
+            with open_warped_aoi(src, bbx, target_crs, src_crs=src_crs, resolution=resolution) as vrt:
+                cropped_data = vrt.read()
+                return cropped_data, vrt.transform, vrt.nodata
 
 
-def reproject_crop_vector(vector_path, bbx, target_crs):
-    # Load the vector data
-    gdf = gpd.read_file(vector_path)
+def reproject_crop_vector(vector_path, bbx, target_crs, columns=None):
+    '''
+    :param columns: optional list of attribute columns to read (e.g. id and height), all columns if None
+    '''
+    # Load only the features that intersect the AOI, filtered by the reader in the CRS of the file
+    gdf = read_vector_in_bbox(vector_path, bbx, target_crs, columns=columns)
 
     # Reproject the vector data to the target CRS
     gdf = gdf.to_crs(target_crs)
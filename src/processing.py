@@ -1,6 +1,8 @@
 import geopandas as gpd
 import rasterio
+from rasterio.features import rasterize
 from rasterio.windows import from_bounds
+import shapely
 from shapely.geometry import Point, box
 from rtree import index
 import numpy as np
@@ -65,14 +67,162 @@ def points_in_polygon(polygon, cell_centers_and_heights, spatial_idx):
     points_within_polygon = [(cell_centers_and_heights[i][0], cell_centers_and_heights[i][1]) for i in candidates if polygon.contains(cell_centers_and_heights[i][0])]  # Exact check
     return points_within_polygon
 
-# Function to process each building and calculate statistics for points inside the polygon
-def process_buildings(cropped_raster_data, cropped_vector_data, transform, nodata_value=None, output_csv_path='building_stats.csv', updated_vector_path = 'building_height_updated.gpkg'):
+# Function to find the column holding the reference building height
+def find_height_column(cropped_vector_data):
+    height_column_names = ['height', 'Height', 'heights', 'Heights', 'building heights', 'Building heights',
+                           'building_height', 'Building_height', 'building_heights', 'Building_heights']
+    for column_name in height_column_names:
+        if column_name in cropped_vector_data.columns:
+            return column_name
+
+    raise KeyError("No column representing building height found in the data.")
+
+
+# Function to collect the valid cell heights of every building with the cell-center R-tree lookup
+def cell_center_building_stats(cropped_raster_data, cropped_vector_data, transform, nodata_value, height_column):
     # Generate cell centers and heights from the cropped raster
     cell_centers_and_heights = generate_cell_centers_and_heights(cropped_raster_data, transform)
 
     # Build the spatial index for all cell centers
     spatial_idx = build_spatial_index(cell_centers_and_heights)
 
+    per_building = []
+    for _, building in cropped_vector_data.iterrows():
+        # Find the cell centers inside the building polygon
+        points_in_poly = points_in_polygon(building.geometry, cell_centers_and_heights, spatial_idx)
+
+        # Collect heights for the points within the polygon, filtering out nodata and extremely large values
+        cell_heights = [height for point, height in points_in_poly
+                        if (nodata_value is None or height != nodata_value) and height < 1e6]
+
+        if cell_heights:
+            per_building.append(calculate_height_stats(cell_heights, building[height_column]))
+        else:
+            per_building.append(None)
+
+    return per_building
+
+
+def _non_overlapping_layers(geometries):
+    """
+    Splits buildings into layers in which no two footprints share interior area, so that each layer can be
+    burned into a single label grid without one building hiding the cells of another.
+    Footprints that only touch along an edge stay in the same layer.
+    """
+    left, right = geometries.sindex.query(geometries, predicate='intersects')
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    if len(left):
+        touching = geometries.iloc[left].touches(geometries.iloc[right], align=False).to_numpy()
+        left, right = left[~touching], right[~touching]
+
+    neighbours = {}
+    for i, j in zip(left, right):
+        neighbours.setdefault(i, []).append(j)
+        neighbours.setdefault(j, []).append(i)
+
+    layer_of = np.zeros(len(geometries), dtype=np.int64)
+    for i in sorted(neighbours):
+        used = {layer_of[j] for j in neighbours[i] if j < i}
+        layer = 0
+        while layer in used:
+            layer += 1
+        layer_of[i] = layer
+
+    return [np.flatnonzero(layer_of == layer) for layer in range(layer_of.max() + 1)] if len(layer_of) else []
+
+
+# Function to compute per-building statistics with a label grid and grouped NumPy reductions
+def zonal_building_stats(cropped_raster_data, cropped_vector_data, transform, nodata_value, height_column):
+    """
+    Computes the same statistics as cell_center_building_stats without building one Point per raster cell.
+    Building footprints are burned into a label grid aligned with the cropped DSM (a cell belongs to a building
+    when its center falls inside the footprint), and max/min/mean/std/count are reduced per label in one pass.
+    The rasterizer also burns cells whose center lies exactly on the footprint boundary, which polygon.contains
+    excludes, so the burned cells along the edges are checked again with shapely.contains_xy.
+
+    Returns a list with one Stats object per building (None if the building covers no valid cell), in the
+    row order of cropped_vector_data.
+    """
+    data = cropped_raster_data[0] if cropped_raster_data.ndim == 3 else cropped_raster_data
+    geometries = cropped_vector_data.geometry.reset_index(drop=True)
+    building_heights = cropped_vector_data[height_column].to_numpy()
+    n_buildings = len(geometries)
+    geometry_array = geometries.to_numpy()
+    shapely.prepare(geometry_array)
+
+    # Cells that would be kept by the cell-center method: not nodata and not extremely large (NaN fails both)
+    values = data.ravel().astype(np.float64)
+    valid = values < 1e6
+    if nodata_value is not None:
+        valid &= values != nodata_value
+
+    cell_labels = []
+    cell_values = []
+    for layer in _non_overlapping_layers(geometries):
+        shapes = [(geometries.iloc[i], i + 1) for i in layer
+                  if geometries.iloc[i] is not None and not geometries.iloc[i].is_empty]
+        if not shapes:
+            continue
+        label_grid = rasterize(shapes, out_shape=data.shape, transform=transform, fill=0,
+                               all_touched=False, dtype='int32').ravel()
+        inside = (label_grid > 0) & valid
+
+        # Only the cells touched by a footprint edge can have their center on the boundary
+        edge_grid = rasterize([(geometry.boundary, 1) for geometry, _ in shapes], out_shape=data.shape,
+                              transform=transform, fill=0, all_touched=True, dtype='uint8').ravel()
+        edge_cells = np.flatnonzero(inside & (edge_grid > 0))
+        if len(edge_cells):
+            rows, cols = np.divmod(edge_cells, data.shape[1])
+            xs, ys = rasterio.transform.xy(transform, rows, cols, offset='center')
+            on_boundary = ~shapely.contains_xy(geometry_array[label_grid[edge_cells] - 1], np.asarray(xs),
+                                               np.asarray(ys))
+            inside[edge_cells[on_boundary]] = False
+
+        cell_labels.append(label_grid[inside] - 1)
+        cell_values.append(values[inside])
+
+    labels = np.concatenate(cell_labels) if cell_labels else np.empty(0, dtype=np.int64)
+    heights = np.concatenate(cell_values) if cell_values else np.empty(0, dtype=np.float64)
+
+    counts = np.bincount(labels, minlength=n_buildings)
+    sums = np.bincount(labels, weights=heights, minlength=n_buildings)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    squared = np.bincount(labels, weights=(heights - means[labels]) ** 2, minlength=n_buildings)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stddevs = np.sqrt(squared / counts)
+
+    # Max and min via sort-and-reduce over contiguous label runs
+    maxs = np.full(n_buildings, np.nan)
+    mins = np.full(n_buildings, np.nan)
+    if len(labels):
+        order = np.argsort(labels, kind='stable')
+        sorted_labels = labels[order]
+        sorted_heights = heights[order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        maxs[sorted_labels[starts]] = np.maximum.reduceat(sorted_heights, starts)
+        mins[sorted_labels[starts]] = np.minimum.reduceat(sorted_heights, starts)
+
+    per_building = []
+    for i in range(n_buildings):
+        if counts[i] == 0:
+            per_building.append(None)
+            continue
+        per_building.append(Stats(
+            max_val=maxs[i],
+            min_val=mins[i],
+            avg_val=means[i],
+            stddev_val=stddevs[i],
+            num_points=int(counts[i]),
+            avg_diff=means[i] - building_heights[i]
+        ))
+
+    return per_building
+
+
+# Function to turn per-building statistics into the CSV, the updated vector and the overall performance
+def summarize_building_stats(per_building, cropped_vector_data, height_column, output_csv_path, updated_vector_path):
     # Store building stats in a dictionary
     building_stats = {}
 
@@ -80,39 +230,13 @@ def process_buildings(cropped_raster_data, cropped_vector_data, transform, nodat
     all_diffs = []
     height_diffs = []
 
-
-    # Find the correct height column
-    height_column_names = ['height', 'Height', 'heights', 'Heights', 'building heights', 'Building heights',
-                           'building_height', 'Building_height', 'building_heights', 'Building_heights']
-    found_column = None
-    for column_name in height_column_names:
-        if column_name in cropped_vector_data.columns:
-            found_column = column_name
-            break
-
-    if found_column is None:
-        raise KeyError("No column representing building height found in the data.")
-
     csv_data = []
 
-    # Loop through each building polygon in the vector file
-    for idx, building in cropped_vector_data.iterrows():
-        # Ensure 'building_id' is defined at the beginning of the loop
+    for (idx, building), stats in zip(cropped_vector_data.iterrows(), per_building):
         building_id = building.get('id', idx)  # Safe assignment using .get() with default fallback to index
+        building_height = building[height_column]
 
-        building_polygon = building.geometry
-        building_height = building[found_column]  # Use the found column
-
-        # Find the cell centers inside the building polygon
-        points_in_poly = points_in_polygon(building_polygon, cell_centers_and_heights, spatial_idx)
-
-        # Collect heights for the points within the polygon, filtering out nodata and extremely large values
-        cell_heights = [height for point, height in points_in_poly
-                        if (nodata_value is None or height != nodata_value) and height < 1e6]
-
-        # Calculate stats if there are any valid points in the polygon
-        if cell_heights:
-            stats = calculate_height_stats(cell_heights, building_height)
+        if stats is not None:
             building_stats[building_id] = stats
 
             # Append the difference to the overall performance list along with the original height
@@ -141,3 +265,26 @@ def process_buildings(cropped_raster_data, cropped_vector_data, transform, nodat
     cropped_vector_data.to_file(updated_vector_path, driver='GPKG')
 
     return building_stats, avg_diff, stddev_diff, cropped_vector_data
+
+
+# Function to process each building and calculate statistics for points inside the polygon
+def process_buildings(cropped_raster_data, cropped_vector_data, transform, nodata_value=None, output_csv_path='building_stats.csv', updated_vector_path = 'building_height_updated.gpkg', method='cell_centers'):
+    '''
+    :param method: 'cell_centers' tests every raster cell center against the polygons through an R-tree,
+        'zonal' burns the polygons into a label grid and reduces the heights per building with NumPy.
+        Both select the cells whose center lies inside the building footprint.
+    '''
+    # Find the correct height column
+    found_column = find_height_column(cropped_vector_data)
+
+    if method == 'zonal':
+        per_building = zonal_building_stats(cropped_raster_data, cropped_vector_data, transform, nodata_value,
+                                            found_column)
+    elif method == 'cell_centers':
+        per_building = cell_center_building_stats(cropped_raster_data, cropped_vector_data, transform,
+                                                  nodata_value, found_column)
+    else:
+        raise ValueError(f"Unknown method '{method}', expected 'cell_centers' or 'zonal'.")
+
+    return summarize_building_stats(per_building, cropped_vector_data, found_column, output_csv_path,
+                                    updated_vector_path)
@@ -1,14 +1,15 @@
 import geopandas as gpd
 from rasterio.mask import mask
+from rasterio.features import rasterize
+from rasterio.windows import Window
 import rasterio
 import numpy as np
-import os
+from shapely.geometry import box
 
-def align_and_crop_raster(raster_path, geojson_path, output_path=None):
-    if output_path and os.path.exists(output_path):
-        print(f"File {output_path} already exists. Skipping reprocessing.")
-        return rasterio.open(output_path), None  # Assuming subsequent processing can handle this
+from result_cache import is_fresh, mark_fresh
+from vector_io import read_vector_in_bbox
 
+def _crop_raster(raster_path, geojson_path):
     with rasterio.open(raster_path) as src:
         gdf = gpd.read_file(geojson_path)
         if gdf.crs != src.crs:
@@ -24,13 +25,46 @@ def align_and_crop_raster(raster_path, geojson_path, output_path=None):
             "transform": out_transform,
             "crs": src.crs
         })
+    return out_image, out_meta
 
-        if output_path:
-            with rasterio.open(output_path, 'w', **out_meta) as dst:
-                dst.write(out_image, 1)
-            return rasterio.open(output_path), None
 
-        return out_image, out_meta
+def _write_cropped(out_image, out_meta, output_path):
+    with rasterio.open(output_path, 'w', **out_meta) as dst:
+        dst.write(out_image)
+
+
+def _read_cropped(path):
+    with rasterio.open(path) as src:
+        return src.read(), src.meta.copy()
+
+
+def align_and_crop_raster(raster_path, geojson_path, output_path=None, cache=None):
+    """
+    Masks and crops a raster to the geometries of a vector file.
+
+    :param output_path: optional path to also save the cropped raster; if it was written from the same inputs
+        and code (see result_cache.is_fresh), it is read instead of cropping again
+    :param cache: optional result_cache.ResultCache; cropped rasters are then reused as long as the inputs and the
+        code are unchanged
+    :return: the cropped data (bands, rows, cols) and its metadata
+    """
+    crop_code = [_crop_raster, _write_cropped]
+    if output_path and is_fresh(output_path, [raster_path, geojson_path], code=crop_code):
+        print(f"File {output_path} is up to date. Skipping reprocessing.")
+        return _read_cropped(output_path)
+
+    if cache is not None:
+        cached_path = cache.cached_file(
+            'crop', lambda path: _write_cropped(*_crop_raster(raster_path, geojson_path), path),
+            inputs=[raster_path, geojson_path], code=crop_code)
+        out_image, out_meta = _read_cropped(cached_path)
+    else:
+        out_image, out_meta = _crop_raster(raster_path, geojson_path)
+
+    if output_path:
+        _write_cropped(out_image, out_meta, output_path)
+        mark_fresh(output_path, [raster_path, geojson_path], code=crop_code)
+    return out_image, out_meta
 
 def calculate_difference(gt_data, gt_meta, model_data, model_meta, difference_path):
     # Validation of shapes and transforms
@@ -55,23 +89,242 @@ def calculate_difference(gt_data, gt_meta, model_data, model_meta, difference_pa
         dst.write(difference, 1)
 
 
-gt_path = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_complete.tif'
-gt_resampled_output = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_comp_1m.tif'
-model_path = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Amsterdam_height.tif'
-model_aligned_output = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Ams_DLheight_a.tif'
+class ErrorAccumulator:
+    """
+    Streaming error metrics of ground truth - model differences that arrive block by block.
+
+    Bias, MAE and RMSE are kept as running sums. Percentiles come from fixed-width histograms of the signed and the
+    absolute difference, accurate to bin_width, so that accumulators of different blocks, zones or workers can be
+    merged by adding them up. Differences outside value_range fall in an underflow/overflow bin.
+    """
+
+    def __init__(self, bin_width=0.01, value_range=(-100, 100)):
+        self.bin_width = bin_width
+        self.value_range = tuple(value_range)
+        self.n_bins = int(np.ceil((value_range[1] - value_range[0]) / bin_width))
+        self.count = 0
+        self.sum = 0.0
+        self.sum_abs = 0.0
+        self.sum_squared = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        # Bin 0 is the underflow and bin n_bins + 1 the overflow
+        self.histogram = np.zeros(self.n_bins + 2, dtype=np.int64)
+        self.abs_histogram = np.zeros(self.n_bins + 2, dtype=np.int64)
+
+    def _bins(self, values, low):
+        bins = np.floor((values - low) / self.bin_width).astype(np.int64) + 1
+        return np.clip(bins, 0, self.n_bins + 1)
+
+    def add(self, difference):
+        """Adds a 1D array of valid differences (ground truth - model)."""
+        difference = np.asarray(difference, dtype=np.float64)
+        if difference.size == 0:
+            return
+        absolute = np.abs(difference)
+        self.count += difference.size
+        self.sum += difference.sum()
+        self.sum_abs += absolute.sum()
+        self.sum_squared += np.square(difference).sum()
+        self.min = min(self.min, difference.min())
+        self.max = max(self.max, difference.max())
+        self.histogram += np.bincount(self._bins(difference, self.value_range[0]), minlength=self.n_bins + 2)
+        self.abs_histogram += np.bincount(self._bins(absolute, 0), minlength=self.n_bins + 2)
+
+    def merge(self, other):
+        """Adds the differences of another accumulator with the same bins."""
+        if other.bin_width != self.bin_width or other.value_range != self.value_range:
+            raise ValueError("Only accumulators with the same bin_width and value_range can be merged.")
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_abs += other.sum_abs
+        self.sum_squared += other.sum_squared
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+        self.abs_histogram += other.abs_histogram
+        return self
+
+    def _percentile(self, histogram, low, q, lowest, highest):
+        cumulative = np.cumsum(histogram)
+        rank = q / 100 * self.count
+        position = int(np.searchsorted(cumulative, rank, side='left'))
+        if position == 0:
+            return lowest
+        if position == self.n_bins + 1:
+            return highest
+        # Linear interpolation inside the bin that holds the rank
+        before = cumulative[position - 1]
+        fraction = (rank - before) / histogram[position] if histogram[position] else 0.0
+        value = low + (position - 1 + fraction) * self.bin_width
+        return float(min(max(value, lowest), highest))
+
+    def result(self, percentiles=(50, 90, 95, 99)):
+        """
+        Returns a dict with count, bias, mae, rmse, min, max and, for every q in percentiles, the percentile of the
+        difference ('p<q>') and of the absolute difference ('abs_p<q>'). Metrics are None if no value was added.
+        """
+        if self.count == 0:
+            keys = ['bias', 'mae', 'rmse', 'min', 'max'] + [f"{prefix}p{q}" for q in percentiles
+                                                            for prefix in ('', 'abs_')]
+            return dict({'count': 0}, **{key: None for key in keys})
+
+        stats = {
+            'count': self.count,
+            'bias': float(self.sum / self.count),
+            'mae': float(self.sum_abs / self.count),
+            'rmse': float(np.sqrt(self.sum_squared / self.count)),
+            'min': float(self.min),
+            'max': float(self.max),
+        }
+        largest_abs = max(abs(self.min), abs(self.max))
+        smallest_abs = 0.0 if self.min <= 0 <= self.max else min(abs(self.min), abs(self.max))
+        for q in percentiles:
+            stats[f"p{q}"] = self._percentile(self.histogram, self.value_range[0], q, stats['min'], stats['max'])
+            stats[f"abs_p{q}"] = self._percentile(self.abs_histogram, 0, q, smallest_abs, largest_abs)
+        return stats
+
+
+def _read_zones(vector_path, src, columns=None):
+    # Features of a zone layer that overlap the raster, in the CRS of the raster
+    gdf = read_vector_in_bbox(vector_path, src.bounds, src.crs, columns=columns)
+    if gdf.crs != src.crs:
+        gdf = gdf.to_crs(src.crs)
+    return gdf[gdf.geometry.notna()].reset_index(drop=True)
+
+
+def _burn_zones(zones, window_bounds, out_shape, transform, values=None):
+    # Rasterizes only the zone features that intersect the block, 0 where no feature is
+    candidates = zones.sindex.query(box(*window_bounds), predicate='intersects')
+    if len(candidates) == 0:
+        return np.zeros(out_shape, dtype=np.int32)
+    geometries = zones.geometry.iloc[candidates]
+    burn_values = np.ones(len(candidates), dtype=np.int32) if values is None else values[candidates]
+    return rasterize(zip(geometries, burn_values), out_shape=out_shape, transform=transform, fill=0,
+                     dtype='int32')
+
+
+def compare_rasters_streaming(gt_path, model_path, buildings_path=None, aoi_path=None, aoi_id_column=None,
+                              difference_path=None, block_size=1024, bin_width=0.01, value_range=(-100, 100),
+                              percentiles=(50, 90, 95, 99)):
+    """
+    Compares an aligned model raster with a ground truth raster in one streaming pass.
+
+    Both rasters are read in matching blocks, so memory is bounded by the block size. The differences
+    (ground truth - model) of the cells that are valid in both rasters are accumulated over the whole raster,
+    inside and outside the building footprints and per AOI polygon. The difference raster is only written if
+    difference_path is given (float32, NaN where either raster has no data).
+
+    :param gt_path: ground truth raster
+    :param model_path: model raster on the same grid as the ground truth (see align_raster)
+    :param buildings_path: optional building footprints (GeoJSON/GPKG) for the inside/outside breakdown
+    :param aoi_path: optional AOI polygons (GeoJSON/GPKG) for a breakdown per polygon; where polygons overlap, the
+        last one wins
+    :param aoi_id_column: column of aoi_path that identifies the polygons, the row number if None
+    :param difference_path: optional path of the difference raster
+    :param block_size: edge length of the blocks in pixels
+    :param bin_width: histogram bin width for the percentiles, in raster units
+    :param value_range: range of differences covered by the histogram bins
+    :param percentiles: percentiles to report
+    :return: dict with the metrics of 'all', 'inside_buildings', 'outside_buildings' and 'aoi' (dict per polygon),
+        see ErrorAccumulator.result; a positive bias means the model is lower than the ground truth
+    """
+    def new_accumulator():
+        return ErrorAccumulator(bin_width, value_range)
+
+    with rasterio.open(gt_path) as gt, rasterio.open(model_path) as model:
+        if gt.shape != model.shape or gt.transform != model.transform:
+            raise ValueError("Ground Truth and Model rasters must be aligned to the same grid")
+
+        overall = new_accumulator()
+        buildings = _read_zones(buildings_path, gt, columns=[]) if buildings_path else None
+        inside, outside = new_accumulator(), new_accumulator()
+
+        aoi, aoi_ids, aoi_accumulators = None, None, {}
+        if aoi_path:
+            aoi = _read_zones(aoi_path, gt, columns=[aoi_id_column] if aoi_id_column else [])
+            aoi_ids = aoi[aoi_id_column].tolist() if aoi_id_column else list(range(len(aoi)))
+            aoi_accumulators = {aoi_id: new_accumulator() for aoi_id in aoi_ids}
+
+        dst = None
+        if difference_path:
+            meta = gt.meta.copy()
+            meta.update({'dtype': 'float32', 'count': 1, 'nodata': np.nan, 'compress': 'deflate'})
+            if gt.width >= 256 and gt.height >= 256:
+                meta.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+            dst = rasterio.open(difference_path, 'w', **meta)
+
+        try:
+            for row in range(0, gt.height, block_size):
+                for col in range(0, gt.width, block_size):
+                    window = Window(col, row, min(block_size, gt.width - col), min(block_size, gt.height - row))
+                    gt_block = gt.read(1, window=window).astype('float32')
+                    model_block = model.read(1, window=window).astype('float32')
+
+                    valid = np.isfinite(gt_block) & np.isfinite(model_block)
+                    if gt.nodata is not None:
+                        valid &= gt_block != gt.nodata
+                    if model.nodata is not None:
+                        valid &= model_block != model.nodata
+                    difference = gt_block - model_block
+
+                    if dst is not None:
+                        dst.write(np.where(valid, difference, np.nan).astype('float32'), 1, window=window)
+                    if not valid.any():
+                        continue
+                    overall.add(difference[valid])
+
+                    transform = gt.window_transform(window)
+                    window_bounds = rasterio.windows.bounds(window, gt.transform)
+                    if buildings is not None:
+                        in_building = _burn_zones(buildings, window_bounds, valid.shape, transform) > 0
+                        inside.add(difference[valid & in_building])
+                        outside.add(difference[valid & ~in_building])
+                    if aoi is not None:
+                        labels = _burn_zones(aoi, window_bounds, valid.shape, transform,
+                                             values=np.arange(1, len(aoi) + 1, dtype=np.int32))
+                        for label in np.unique(labels[valid]):
+                            if label > 0:
+                                aoi_accumulators[aoi_ids[label - 1]].add(difference[valid & (labels == label)])
+        finally:
+            if dst is not None:
+                dst.close()
+
+    report = {'all': overall.result(percentiles)}
+    if buildings is not None:
+        report['inside_buildings'] = inside.result(percentiles)
+        report['outside_buildings'] = outside.result(percentiles)
+    if aoi is not None:
+        report['aoi'] = {aoi_id: accumulator.result(percentiles) for aoi_id, accumulator in aoi_accumulators.items()}
+
+    for zone in ('all', 'inside_buildings', 'outside_buildings'):
+        if zone in report and report[zone]['count']:
+            stats = report[zone]
+            print(f"{zone}: n={stats['count']}, bias={stats['bias']:.3f}, MAE={stats['mae']:.3f}, "
+                  f"RMSE={stats['rmse']:.3f}")
+    if difference_path:
+        print(f"Difference raster saved to {difference_path}")
+    return report
+
+
+if __name__ == "__main__":
+    gt_path = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_complete.tif'
+    gt_resampled_output = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_comp_1m.tif'
+    model_path = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Amsterdam_height.tif'
+    model_aligned_output = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Ams_DLheight_a.tif'
 
-amsterdam_geojson = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Boundary_AMS.GeoJSON'
-overture_buildings_geojson = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Amsterdam_overturebuildings.geojson'
-difference_path = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\diff_gt-dl.tif'
+    amsterdam_geojson = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Boundary_AMS.GeoJSON'
+    overture_buildings_geojson = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Amsterdam_overturebuildings.geojson'
+    difference_path = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\diff_gt-dl.tif'
 
-gt_resampled = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Ams_DLheight_a.tif'
-model_aligned = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_comp_1m.tif'
+    gt_resampled = r'C:\Users\zhuoyue.wang\Documents\DLmodel_Amsterdam\Ams_DLheight_a.tif'
+    model_aligned = r'C:\Users\zhuoyue.wang\Documents\Amsterdam_data\DSM_AMS_m_comp_1m.tif'
 
-# Crop both layers by Amsterdam boundary and then by overture buildings
-gt_cropped_data1, gt_cropped_meta = align_and_crop_raster(gt_resampled, amsterdam_geojson)
-model_cropped_data1, model_cropped_meta = align_and_crop_raster(model_aligned, amsterdam_geojson)
+    # Crop both layers by Amsterdam boundary and then by overture buildings
+    gt_cropped_data1, gt_cropped_meta = align_and_crop_raster(gt_resampled, amsterdam_geojson)
+    model_cropped_data1, model_cropped_meta = align_and_crop_raster(model_aligned, amsterdam_geojson)
 
-gt_cropped_data2, gt_cropped_meta1 = align_and_crop_raster(gt_resampled, overture_buildings_geojson)
-model_cropped_data2, model_cropped_meta1 = align_and_crop_raster(model_aligned, overture_buildings_geojson)
+    gt_cropped_data2, gt_cropped_meta1 = align_and_crop_raster(gt_resampled, overture_buildings_geojson)
+    model_cropped_data2, model_cropped_meta1 = align_and_crop_raster(model_aligned, overture_buildings_geojson)
 
-calculate_difference(gt_cropped_data2, gt_cropped_meta, model_cropped_data2, model_cropped_meta, difference_path)
\ No newline at end of file
+    calculate_difference(gt_cropped_data2, gt_cropped_meta, model_cropped_data2, model_cropped_meta, difference_path)
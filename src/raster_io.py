@@ -0,0 +1,101 @@
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.warp import reproject
+
+
+def in_memory_raster(data, transform, crs, nodata=None):
+    '''
+    Single-band raster held in memory, passed between pipeline stages instead of a GeoTIFF on disk.
+
+    :param data: 2D array
+    :param transform: affine transform of data
+    :param crs: anything rasterio understands as a CRS (EPSG string, rasterio or pyproj CRS)
+    :param nodata: nodata value of data, or None
+    :return: dict with the keys data, transform, crs and nodata
+    '''
+    return {"data": data, "transform": transform, "crs": CRS.from_user_input(crs) if crs is not None else None,
+            "nodata": nodata}
+
+
+def read_raster(source):
+    '''
+    Returns the first band of source as an in-memory raster.
+
+    :param source: path of a raster file, or an in-memory raster (returned as is)
+    '''
+    if isinstance(source, dict):
+        return source
+    with rasterio.open(source) as src:
+        return in_memory_raster(src.read(1), src.transform, src.crs, src.nodata)
+
+
+def write_raster(raster, output_path):
+    '''
+    Writes an in-memory raster to a tiled, compressed GeoTIFF.
+
+    :return: output_path
+    '''
+    data = raster["data"]
+    height, width = data.shape
+    profile = {
+        "driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": data.dtype,
+        "crs": raster["crs"], "transform": raster["transform"], "nodata": raster["nodata"],
+        "compress": "deflate",
+    }
+    if height >= 256 and width >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(data, 1)
+    return output_path
+
+
+def checkpoint(raster, output_path=None):
+    '''
+    Optionally saves an intermediate raster of a pipeline and passes it on unchanged.
+
+    :param output_path: path to write the raster to, or None to keep it in memory only
+    :return: raster
+    '''
+    if output_path:
+        write_raster(raster, output_path)
+        print(f"Checkpoint saved to {output_path}")
+    return raster
+
+
+def warp_to_grid(source, grid, resampling=Resampling.bilinear):
+    '''
+    Resamples a raster onto the grid of another one (CRS, transform and shape), entirely in memory.
+
+    :param source: path of a raster file or an in-memory raster
+    :param grid: in-memory raster whose grid is the target
+    :return: float32 in-memory raster on the target grid, NaN where source has no data
+    '''
+    if isinstance(source, dict):
+        source_data, source_transform = source["data"], source["transform"]
+        source_crs, source_nodata = source["crs"], source["nodata"]
+    else:
+        src = rasterio.open(source)
+        source_data, source_transform, source_crs, source_nodata = rasterio.band(src, 1), src.transform, src.crs, \
+            src.nodata
+
+    destination = np.full(grid["data"].shape, np.nan, dtype=np.float32)
+    try:
+        reproject(
+            source=source_data,
+            destination=destination,
+            src_transform=source_transform,
+            src_crs=source_crs,
+            src_nodata=source_nodata,
+            dst_transform=grid["transform"],
+            dst_crs=grid["crs"],
+            dst_nodata=np.nan,
+            resampling=resampling
+        )
+    finally:
+        if not isinstance(source, dict):
+            src.close()
+
+    return in_memory_raster(destination, grid["transform"], grid["crs"], np.nan)
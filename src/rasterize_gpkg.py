@@ -1,14 +1,130 @@
 import rasterio
 from rasterio.features import rasterize
 from rasterio.transform import from_origin
+from rasterio.windows import Window
 import geopandas as gpd
 import numpy as np
-import fiona
+import pandas as pd
 import pyproj
 import os
+from shapely.geometry import box
 
+from raster_io import in_memory_raster
+from vector_io import read_vector_in_bbox, read_vector_schema
 
-def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
+
+def _burn_shapes(input_gdf, out_shape, transform, value_column=None, dtype='uint8', merge='last'):
+    """
+    Burns the geometries of input_gdf into a new array, 0 where no geometry is.
+    Geometries are burned in row order, so later ones overwrite earlier ones ('last'); for 'max' they are burned
+    in increasing value order instead, so every cell keeps the largest value.
+    """
+    if merge not in ('last', 'max'):
+        raise ValueError(f"Unknown merge rule '{merge}', expected 'last' or 'max'.")
+
+    present = input_gdf.geometry.notna().to_numpy()
+    geometries = input_gdf.geometry[present]
+    if value_column is None:
+        values = np.ones(len(geometries))
+    else:
+        if value_column not in input_gdf.columns:
+            raise ValueError(f"Column '{value_column}' to burn is not in the vector data.")
+        values = input_gdf[value_column].to_numpy()[present]
+        keep = ~pd.isna(values)
+        geometries, values = geometries[keep], values[keep]
+    if merge == 'max':
+        order = np.argsort(values, kind='stable')
+        geometries, values = geometries.iloc[order], values[order]
+
+    if len(values) == 0:
+        return np.zeros(out_shape, dtype=dtype)
+
+    # Prepare shapes for rasterization
+    shapes = zip(geometries, values)
+
+    # Rasterize the data
+    return rasterize(
+        shapes=shapes,
+        out_shape=out_shape,
+        transform=transform,
+        fill=0,  # Background value
+        all_touched=True,
+        dtype=dtype
+    )
+
+
+def _raster_grid(bounds, resolution):
+    # Define the raster bounds and dimensions
+    minx, miny, maxx, maxy = bounds
+    width = int((maxx - minx) / resolution)
+    height = int((maxy - miny) / resolution)
+    transform = from_origin(minx, maxy, resolution, resolution)
+    return transform, height, width
+
+
+def rasterize_gdf(input_gdf, resolution=1, bounds=None, value_column=None, dtype='uint8', merge='last'):
+    """
+    Rasterizes the footprints of a GeoDataFrame in memory.
+
+    Parameters:
+    - input_gdf (GeoDataFrame): Footprints to burn.
+    - resolution (float): Resolution of the raster in units of the GeoDataFrame CRS (default is 1).
+    - bounds (tuple, optional): (minx, miny, maxx, maxy) of the raster; the extent of input_gdf if None.
+    - value_column (str, optional): Attribute to burn (e.g. height or id); 1 is burned if None.
+    - dtype (str): Data type of the raster.
+    - merge (str): Value of cells covered by several footprints: 'last' (last footprint in row order) or 'max'.
+
+    Returns:
+    - dict: in-memory raster (data, transform, crs, nodata 0), see raster_io.in_memory_raster.
+    """
+    transform, height, width = _raster_grid(input_gdf.total_bounds if bounds is None else bounds, resolution)
+    raster = _burn_shapes(input_gdf, (height, width), transform, value_column, dtype, merge)
+    return in_memory_raster(raster, transform, input_gdf.crs, 0)
+
+
+def rasterize_gdf_tiled(input_gdf, output_file, resolution=1, bounds=None, value_column=None, dtype='uint8',
+                        merge='last', tile_size=4096):
+    """
+    Rasterizes the footprints of a GeoDataFrame tile by tile into a tiled GeoTIFF.
+
+    Every output tile selects its footprints through the spatial index of input_gdf and is written as soon as it
+    is burned, so memory is bounded by the tile size instead of by the extent. The result is the same as the one
+    of rasterize_gdf.
+
+    Parameters:
+    - output_file (str): Path to the output raster file.
+    - tile_size (int): Edge length of the output tiles in pixels (a multiple of 256).
+    - other parameters: see rasterize_gdf.
+
+    Returns:
+    - str: output_file.
+    """
+    transform, height, width = _raster_grid(input_gdf.total_bounds if bounds is None else bounds, resolution)
+    profile = {
+        "driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": dtype,
+        "crs": input_gdf.crs.to_string(), "transform": transform, "nodata": 0, "compress": "deflate",
+    }
+    if height >= 256 and width >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    input_gdf = input_gdf[input_gdf.geometry.notna()].reset_index(drop=True)
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for row in range(0, height, tile_size):
+            for col in range(0, width, tile_size):
+                window = Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+                tile_bounds = rasterio.windows.bounds(window, transform)
+                candidates = np.sort(input_gdf.sindex.query(box(*tile_bounds), predicate='intersects'))
+                if len(candidates) == 0:
+                    continue  # Unwritten tiles read as nodata
+                tile = _burn_shapes(input_gdf.iloc[candidates], (int(window.height), int(window.width)),
+                                    rasterio.windows.transform(window, transform), value_column, dtype, merge)
+                dst.write(tile, 1, window=window)
+
+    return output_file
+
+
+def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1, value_column=None, dtype='uint8',
+                   merge='last', tile_size=None):
     """
     Rasterizes a GeoPackage (GPKG) file into a raster file.
 
@@ -17,15 +133,18 @@ def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
     - output_file (str): Path to the output raster file.
     - aoi_file (str, optional): Path to the AOI GPKG file for cropping and CRS transformation. If None, the full input GPKG is used.
     - resolution (float): Resolution of the output raster in the same units as the GPKG/AOI CRS (default is 1).
+    - value_column (str, optional): Attribute to burn (e.g. 'height' or an id); 1 is burned if None.
+    - dtype (str): Data type of the raster (e.g. 'float32' for heights).
+    - merge (str): Value of cells covered by several footprints: 'last' or 'max'.
+    - tile_size (int, optional): Rasterize and write in tiles of tile_size pixels instead of one array (large extents).
 
     Returns:
     - str: Path to the rasterized TIFF file.
     """
-
-    # Load the input GeoPackage
-    input_gdf = gpd.read_file(input_file)
-    if input_gdf.empty:
-        raise ValueError("The input GeoPackage is empty or invalid.")
+    columns = [value_column] if value_column else []
+    if value_column and value_column not in read_vector_schema(input_file)[1]:
+        # read_vector_in_bbox skips unknown columns, so fail before reading instead of when burning
+        raise ValueError(f"Column '{value_column}' to burn is not in {input_file}.")
 
     # If an AOI is provided, use it to define the bounding box and CRS
     if aoi_file:
@@ -37,6 +156,11 @@ def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
         aoi_bounds = aoi_gdf.total_bounds  # [minx, miny, maxx, maxy]
         aoi_crs = aoi_gdf.crs
 
+        # Load only the footprints intersecting the AOI, with the burned attribute if any
+        input_gdf = read_vector_in_bbox(input_file, aoi_bounds, aoi_crs, columns=columns)
+        if input_gdf.empty:
+            raise ValueError("No features remain after cropping to the AOI.")
+
         # Reproject the input GeoPackage to match the AOI CRS if necessary
         if input_gdf.crs != aoi_crs:
             input_gdf = input_gdf.to_crs(aoi_crs)
@@ -47,27 +171,22 @@ def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
             raise ValueError("No features remain after cropping to the AOI.")
 
     else:
+        # Load the input GeoPackage
+        input_gdf = gpd.read_file(input_file, columns=columns)
+        if input_gdf.empty:
+            raise ValueError("The input GeoPackage is empty or invalid.")
+
         aoi_bounds = input_gdf.total_bounds  # Use full dataset bounds
         aoi_crs = input_gdf.crs
 
-    # Define the raster bounds and dimensions
-    minx, miny, maxx, maxy = aoi_bounds
-    width = int((maxx - minx) / resolution)
-    height = int((maxy - miny) / resolution)
-    transform = from_origin(minx, maxy, resolution, resolution)
+    if tile_size:
+        rasterize_gdf_tiled(input_gdf, output_file, resolution, aoi_bounds, value_column, dtype, merge, tile_size)
+        print(f"Rasterization complete. Output saved to {output_file}")
+        return output_file
 
-    # Prepare shapes for rasterization
-    shapes = [(geom, 1) for geom in input_gdf.geometry if geom is not None]
-
-    # Rasterize the data
-    raster = rasterize(
-        shapes=shapes,
-        out_shape=(height, width),
-        transform=transform,
-        fill=0,  # Background value
-        all_touched=True,
-        dtype='uint8'
-    )
+    building_raster = rasterize_gdf(input_gdf, resolution, aoi_bounds, value_column, dtype, merge)
+    raster, transform = building_raster["data"], building_raster["transform"]
+    height, width = raster.shape
 
     # Write the raster to a GeoTIFF file
     with rasterio.open(
@@ -77,7 +196,7 @@ def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
             height=height,
             width=width,
             count=1,
-            dtype='uint8',
+            dtype=dtype,
             crs=aoi_crs.to_string(),
             transform=transform,
             nodata=0
@@ -89,10 +208,11 @@ def rasterize_gpkg(input_file, output_file, aoi_file=None, resolution=1):
     return output_file
 
 
-# Example usage
-input_gpkg = r"C:\Users\www\WRI-cif\GLOBAL_COM\UT_Amsterdam.gpkg"
-aoi_gpkg = r"C:\Users\www\WRI-cif\GLOBAL_COM\AOI_2_utm.gpkg"
-output_tif = r"C:\Users\www\WRI-cif\GLOBAL_COM\UT_raster_AOI2.tif"
-resolution = 1
+if __name__ == "__main__":
+    # Example usage
+    input_gpkg = r"C:\Users\www\WRI-cif\GLOBAL_COM\UT_Amsterdam.gpkg"
+    aoi_gpkg = r"C:\Users\www\WRI-cif\GLOBAL_COM\AOI_2_utm.gpkg"
+    output_tif = r"C:\Users\www\WRI-cif\GLOBAL_COM\UT_raster_AOI2.tif"
+    resolution = 1
 
-rasterize_gpkg(input_gpkg, output_tif, aoi_gpkg, resolution)
+    rasterize_gpkg(input_gpkg, output_tif, aoi_gpkg, resolution)
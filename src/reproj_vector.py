@@ -1,4 +1,7 @@
 import geopandas as gpd
+from shapely.geometry import box
+
+from vector_io import read_vector_in_bbox
 
 
 def reproject_layer(input_path, output_path, target_crs="EPSG:32631"):
@@ -28,5 +31,36 @@ def reproject_layer(input_path, output_path, target_crs="EPSG:32631"):
     print(f"Layer has been reprojected and saved to {output_path}.")
 
 
-# Example usage
-reproject_layer(r"C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\ams_overture_height_reproj1.geojson", r"C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\aoi1_overture_height_utm1.geojson")
+def crop_reproj_vector(input_path, output_path, target_crs, bbx, bbx_crs=None):
+    """
+    Crops a vector layer to a bounding box and reprojects it, keeping the result in memory.
+
+    Parameters:
+        input_path (str): Path to the input GeoJSON or GPKG file.
+        output_path (str): Optional path to also save the cropped layer (GPKG); None keeps it in memory only.
+        target_crs (str): The EPSG code of the target CRS.
+        bbx (dict or tuple): Bounding box as {"xmin", "ymin", "xmax", "ymax"} or (minx, miny, maxx, maxy).
+        bbx_crs (str): CRS of bbx; if None, bbx is in the CRS of the input file.
+
+    Returns:
+        GeoDataFrame: The cropped features in target_crs.
+    """
+    if isinstance(bbx, dict):
+        bbx = (bbx["xmin"], bbx["ymin"], bbx["xmax"], bbx["ymax"])
+
+    # Only the features intersecting the box are read from the file
+    gdf = read_vector_in_bbox(input_path, bbx, bbx_crs)
+    if bbx_crs is not None:
+        gdf = gdf.to_crs(bbx_crs)
+    gdf = gdf.clip(box(*bbx))
+    gdf = gdf.to_crs(target_crs)
+
+    if output_path:
+        gdf.to_file(output_path, driver='GPKG')
+        print(f"Cropped layer saved to {output_path}.")
+    return gdf
+
+
+if __name__ == "__main__":
+    # Example usage
+    reproject_layer(r"C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\ams_overture_height_reproj1.geojson", r"C:\Users\zhuoyue.wang\Documents\Amsterdam_data\Height_validation\aoi1_overture_height_utm1.geojson")
@@ -3,6 +3,8 @@ import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.crs import CRS
 from rasterio.env import Env
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 import numpy as np
 
 # **Set PROJ_LIB to ensure Rasterio finds the correct proj.db**
@@ -25,8 +27,56 @@ def force_crs(input_raster_path, output_raster_path, forced_epsg):
     return output_raster_path
 
 
-def transform_raster(input_raster_path, output_raster_path, src_epsg, dst_epsg):
-    """ Reprojects a raster from src_epsg to dst_epsg. """
+def transform_raster_windowed(input_raster_path, output_raster_path, src_epsg, dst_epsg, block_size=1024,
+                              num_threads='ALL_CPUS', resampling=Resampling.nearest):
+    """
+    Reprojects a raster from src_epsg to dst_epsg block by block, without copying it first.
+
+    The source CRS is overridden in a virtual warped view instead of being written to a _fixed_crs.tif copy.
+    All bands of one output block are warped together by GDAL with num_threads threads and written to a tiled,
+    compressed GeoTIFF, so the raster is read and written once and memory is bounded by the block size.
+    The output grid is the same as the one of transform_raster.
+    """
+    src_crs = CRS.from_epsg(src_epsg)
+    dst_crs = CRS.from_epsg(dst_epsg)
+
+    with rasterio.open(input_raster_path) as src:
+        transform, width, height = calculate_default_transform(
+            src_crs, dst_crs, src.width, src.height, *src.bounds)
+
+        kwargs = src.meta.copy()
+        kwargs.update({
+            'crs': dst_crs,
+            'transform': transform,
+            'width': width,
+            'height': height,
+            'compress': 'deflate',
+        })
+        if width >= 256 and height >= 256:
+            kwargs.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+
+        with WarpedVRT(src, src_crs=src_crs, crs=dst_crs, transform=transform, width=width, height=height,
+                       resampling=resampling, warp_extras={'NUM_THREADS': num_threads}) as vrt, \
+                rasterio.open(output_raster_path, 'w', **kwargs) as dst:
+            for row in range(0, height, block_size):
+                for col in range(0, width, block_size):
+                    window = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                    dst.write(vrt.read(window=window), window=window)
+
+    print(f"Transformation complete: {input_raster_path} → {output_raster_path}")
+    return output_raster_path
+
+
+def transform_raster(input_raster_path, output_raster_path, src_epsg, dst_epsg, windowed=False, block_size=1024,
+                     num_threads='ALL_CPUS'):
+    """
+    Reprojects a raster from src_epsg to dst_epsg.
+    With windowed=True the CRS is overridden virtually and the raster is warped block by block,
+    see transform_raster_windowed.
+    """
+    if windowed:
+        return transform_raster_windowed(input_raster_path, output_raster_path, src_epsg, dst_epsg,
+                                         block_size=block_size, num_threads=num_threads)
 
     # **First, force the CRS onto the raster to avoid EngineeringCRS issues**
     corrected_raster_path = input_raster_path.replace(".tif", "_fixed_crs.tif")
@@ -75,10 +125,11 @@ def transform_raster(input_raster_path, output_raster_path, src_epsg, dst_epsg):
     print(f"Transformation complete: {input_raster_path} → {output_raster_path}")
 
 
-# Paths and EPSG codes
-input_raster = r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem.tif'
-output_raster = r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm.tif'
-source_crs = 28992  # Amersfoort / RD New (Force this CRS)
-destination_crs = 32631  # UTM Zone 31N
+if __name__ == "__main__":
+    # Paths and EPSG codes
+    input_raster = r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem.tif'
+    output_raster = r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_local_dem_utm.tif'
+    source_crs = 28992  # Amersfoort / RD New (Force this CRS)
+    destination_crs = 32631  # UTM Zone 31N
 
-transform_raster(input_raster, output_raster, source_crs, destination_crs)
+    transform_raster(input_raster, output_raster, source_crs, destination_crs)
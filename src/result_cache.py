@@ -0,0 +1,182 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+
+def file_identity(path, content_hash=False):
+    '''
+    Identifies the version of an input file without reading it: absolute path, size and modification time.
+    With content_hash=True the SHA-256 of the content is used instead, so that copies or touched files with the
+    same content keep their identity. Paths that are not local files (e.g. URLs) are identified by the path only.
+    '''
+    if not os.path.isfile(path):
+        return {"path": str(path)}
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return {"sha256": digest.hexdigest()}
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def code_version(*objects):
+    '''
+    Hash of the source code of the given functions, classes or modules, so that cached results are invalidated when
+    the code that produced them changes.
+    '''
+    digest = hashlib.sha256()
+    for obj in objects:
+        try:
+            digest.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            digest.update(repr(obj).encode())
+    return digest.hexdigest()[:16]
+
+
+def cache_key(stage, inputs, params=None, code=None, content_hash=False):
+    '''
+    Content-addressed key of one pipeline artifact.
+
+    :param stage: name of the stage, e.g. 'crop' or 'building_stats'
+    :param inputs: list of input file paths
+    :param params: JSON-serializable parameters of the stage (other values are serialized with repr)
+    :param code: functions, classes or modules whose source code is part of the key
+    :param content_hash: hash the content of the inputs instead of using their size and modification time
+    '''
+    description = {
+        "stage": stage,
+        "inputs": [file_identity(path, content_hash) for path in inputs],
+        "params": params or {},
+        "code": code_version(*code) if code else None,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()[:32]
+
+
+def _freshness_path(output_path):
+    return output_path + '.cachekey'
+
+
+def _freshness_record(output_path, input_paths, params, code, content_hash):
+    return {"key": cache_key('output', input_paths, params, code, content_hash),
+            "output": file_identity(output_path, content_hash)}
+
+
+def is_fresh(output_path, input_paths, params=None, code=None, content_hash=False):
+    '''
+    True if output_path was written by mark_fresh for the same inputs, parameters and code, and was not changed
+    since. Inputs are compared by their identity (see file_identity), not by being older than the output, so an
+    input replaced by a file with an older modification time (restored from a backup, cp -p) is detected too.
+    '''
+    record_path = _freshness_path(output_path)
+    if not os.path.exists(output_path) or not os.path.exists(record_path):
+        return False
+    with open(record_path) as f:
+        record = json.load(f)
+    return record == _freshness_record(output_path, input_paths, params, code, content_hash)
+
+
+def mark_fresh(output_path, input_paths, params=None, code=None, content_hash=False):
+    '''
+    Records next to output_path (in output_path + '.cachekey') which inputs, parameters and code produced it,
+    for is_fresh.
+    '''
+    with open(_freshness_path(output_path), 'w') as f:
+        json.dump(_freshness_record(output_path, input_paths, params, code, content_hash), f)
+
+
+class ResultCache:
+    '''
+    On-disk store of expensive pipeline artifacts (cropped and aligned rasters, filled DEMs, zonal stats) keyed
+    by cache_key. A stage is only recomputed when one of its inputs, its parameters or its code changed.
+    Entries are files in one directory; when the directory grows beyond max_bytes, the least recently used
+    entries are evicted. Use is tracked in the access time of an entry, so that its modification time (part of
+    the key of the stages that read it) stays the one of the build.
+    '''
+
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3, content_hash=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, stage, key, suffix):
+        return os.path.join(self.directory, f"{stage}-{key}{suffix}")
+
+    def _hit(self, path, stage):
+        if not os.path.exists(path):
+            return False
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))  # Mark as recently used for the eviction
+        print(f"Using cached {stage} result {path}")
+        return True
+
+    def cached_file(self, stage, build, inputs, params=None, code=None, suffix='.tif'):
+        '''
+        Returns the path of the cached artifact, building it first if it is missing or stale.
+
+        :param build: function that writes the artifact to the path it is given
+        :return: path of the artifact in the cache directory
+        '''
+        key = cache_key(stage, inputs, params, code or [build], self.content_hash)
+        path = self._entry(stage, key, suffix)
+        if self._hit(path, stage):
+            return path
+
+        temporary_path = self._entry(stage, key, '.tmp' + suffix)
+        build(temporary_path)
+        os.replace(temporary_path, path)  # Never leave a partial artifact under the final name
+        self.evict(keep=path)
+        return path
+
+    def cached_value(self, stage, compute, inputs, params=None, code=None, outputs=None):
+        '''
+        Returns the cached return value of compute(), computing and pickling it first if it is missing or stale.
+
+        :param outputs: files that compute() writes besides its return value; the cached value is only used if
+            they are still the files written by this computation (not removed or overwritten by another run)
+        '''
+        outputs = list(outputs or [])
+        key = cache_key(stage, inputs, dict(params or {}, outputs=outputs), code or [compute], self.content_hash)
+        path = self._entry(stage, key, '.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            if entry["outputs"] == [file_identity(output, self.content_hash) for output in outputs]:
+                self._hit(path, stage)
+                return entry["value"]
+
+        value = compute()
+        entry = {"value": value, "outputs": [file_identity(output, self.content_hash) for output in outputs]}
+        temporary_path = self._entry(stage, key, '.tmp.pkl')
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+        return value
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes.
+
+        :param keep: entry that is never evicted, e.g. the one just written, even if it alone exceeds max_bytes
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and '.tmp' not in name:
+                stat = os.stat(path)
+                entries.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and os.path.samefile(path, keep):
+                continue
+            os.remove(path)
+            total -= size
+            print(f"Evicted {path} from the cache")
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.windows import from_bounds, Window
+
+from pre_processing_new import get_bbx_and_crs, reproject_crop_vector, snap_window, open_warped_aoi, resolve_crs
+from processing import find_height_column, zonal_building_stats, summarize_building_stats
+
+
+class DSMBlockCache:
+    """
+    LRU cache of fixed-size blocks of the first band of an open raster.
+    Windows are assembled from the cached blocks, so neighbouring buildings do not read the same pixels twice
+    and only the blocks that contain buildings are ever read from disk.
+    """
+
+    def __init__(self, src, block_size=512, max_blocks=64):
+        self.src = src
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.reads = 0
+
+    def _block(self, block_row, block_col):
+        key = (block_row, block_col)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        window = Window(block_col * self.block_size, block_row * self.block_size,
+                        min(self.block_size, self.src.width - block_col * self.block_size),
+                        min(self.block_size, self.src.height - block_row * self.block_size))
+        block = self.src.read(1, window=window)
+        self.reads += 1
+
+        self.blocks[key] = block
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def read(self, bounds):
+        """
+        Reads the pixels covering bounds (minx, miny, maxx, maxy), snapped outwards to whole pixels.
+        Returns the 2D array and its transform.
+        """
+        window = snap_window(from_bounds(*bounds, self.src.transform), self.src.width, self.src.height)
+        row_start, col_start = int(window.row_off), int(window.col_off)
+        row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+
+        data = np.empty((row_stop - row_start, col_stop - col_start), dtype=self.src.dtypes[0])
+        if data.size == 0:
+            return data, self.src.window_transform(window)
+
+        bs = self.block_size
+        for block_row in range(row_start // bs, (row_stop - 1) // bs + 1):
+            for block_col in range(col_start // bs, (col_stop - 1) // bs + 1):
+                block = self._block(block_row, block_col)
+                r0, c0 = block_row * bs, block_col * bs
+                r_from, r_to = max(row_start, r0), min(row_stop, r0 + block.shape[0])
+                c_from, c_to = max(col_start, c0), min(col_stop, c0 + block.shape[1])
+                data[r_from - row_start:r_to - row_start, c_from - col_start:c_to - col_start] = \
+                    block[r_from - r0:r_to - r0, c_from - c0:c_to - c0]
+
+        return data, self.src.window_transform(window)
+
+
+def _morton_order(rows, cols):
+    # Interleave the bits of the block row and column (Z-order curve) so consecutive blocks are spatial neighbours
+    rows = rows.astype(np.uint64)
+    cols = cols.astype(np.uint64)
+    code = np.zeros(len(rows), dtype=np.uint64)
+    for bit in range(32):
+        code |= ((rows >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+        code |= ((cols >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+    return np.argsort(code, kind='stable')
+
+
+def _stream_building_stats(src, cropped_vector, height_column, block_size, max_blocks):
+    per_building = [None] * len(cropped_vector)
+    cache = DSMBlockCache(src, block_size=block_size, max_blocks=max_blocks)
+
+    # Block of the DSM that holds each building's representative point
+    points = cropped_vector.geometry.representative_point()
+    rows, cols = rasterio.transform.rowcol(src.transform, points.x.to_numpy(), points.y.to_numpy())
+    block_rows = np.clip(np.asarray(rows) // block_size, 0, None)
+    block_cols = np.clip(np.asarray(cols) // block_size, 0, None)
+
+    order = _morton_order(block_rows, block_cols)
+    keys = block_rows[order] * (src.width // block_size + 2) + block_cols[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    for positions in np.split(order, starts[1:]):
+        batch = cropped_vector.iloc[positions][['geometry', height_column]]
+        data, transform = cache.read(batch.total_bounds)
+        if data.size == 0:
+            continue  # Buildings outside the DSM extent keep no stats
+        batch_stats = zonal_building_stats(data, batch, transform, src.nodata, height_column)
+        for position, stats in zip(positions, batch_stats):
+            per_building[position] = stats
+
+    print(f"Read {cache.reads} DSM blocks of {block_size} x {block_size} pixels")
+    return per_building
+
+
+def process_buildings_streaming(input_aoi_vector, dsm_raster_path, building_height_vector_path,
+                                output_csv_path='building_stats.csv',
+                                updated_vector_path='building_height_updated.gpkg',
+                                block_size=512, max_blocks=64):
+    '''
+    Streaming version of preprocessing + process_buildings that never loads the AOI raster as a whole.
+
+    Buildings are grouped by the DSM block that contains their representative point and the groups are visited
+    in Z-order. Each group only reads the small window around its own buildings through an LRU cache of DSM
+    blocks, so memory is bounded by block_size * max_blocks instead of by the AOI, and blocks without buildings
+    are never read. A DSM in another CRS is warped block by block through a virtual view of the AOI.
+
+    :param block_size: edge length in pixels of the cached DSM blocks
+    :param max_blocks: number of blocks kept in the LRU cache
+    :return: building_stats, avg_diff, stddev_diff, updated vector (same as process_buildings)
+    '''
+    bbx, crs = get_bbx_and_crs(input_aoi_vector)
+    cropped_vector = reproject_crop_vector(building_height_vector_path, bbx, crs)
+    height_column = find_height_column(cropped_vector)
+
+    with rasterio.open(dsm_raster_path) as dataset:
+        # Same CRS defaults as reproject_crop_raster, so a DSM without CRS is warped like in the other modes
+        src_crs, target_crs = resolve_crs(dataset, crs)
+        if src_crs == target_crs:
+            per_building = _stream_building_stats(dataset, cropped_vector, height_column, block_size, max_blocks)
+        else:
+            # Blocks are warped on the fly from a virtual reprojected view of the AOI
+            with open_warped_aoi(dataset, bbx, target_crs, src_crs=src_crs) as vrt:
+                per_building = _stream_building_stats(vrt, cropped_vector, height_column, block_size, max_blocks)
+
+    return summarize_building_stats(per_building, cropped_vector, height_column, output_csv_path,
+                                    updated_vector_path)
@@ -0,0 +1,84 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+
+from pre_processing_new import (get_bbx_and_crs, reproject_crop_raster, reproject_crop_vector, resolve_crs,
+                                describe_reprojection)
+from processing import find_height_column, zonal_building_stats, summarize_building_stats
+
+
+def assign_buildings_to_tiles(cropped_vector, bbx, tile_size):
+    '''
+    Assigns every building to exactly one tile of a regular grid laid over the AOI bounding box.
+
+    :param cropped_vector: GeoDataFrame with the buildings clipped to the AOI
+    :param bbx: AOI bounding box (minx, miny, maxx, maxy) in the CRS of the buildings
+    :param tile_size: tile edge length in CRS units
+    :return: one tile number per building, in the row order of cropped_vector
+    '''
+    n_cols = max(1, math.ceil((bbx[2] - bbx[0]) / tile_size))
+    n_rows = max(1, math.ceil((bbx[3] - bbx[1]) / tile_size))
+
+    # The representative point always lies inside the footprint, unlike the centroid
+    points = cropped_vector.geometry.representative_point()
+    cols = np.clip(np.floor((points.x.to_numpy() - bbx[0]) / tile_size), 0, n_cols - 1).astype(np.int64)
+    rows = np.clip(np.floor((bbx[3] - points.y.to_numpy()) / tile_size), 0, n_rows - 1).astype(np.int64)
+    return rows * n_cols + cols
+
+
+def process_tile(task):
+    '''
+    Worker for one tile: reads only the DSM window that covers the tile's buildings and computes their zonal stats.
+    Buildings can reach beyond the tile edge, so the window is the extent of the buildings, not of the tile.
+    Workers stay silent; the CRS check is reported once by process_buildings_tiled.
+    '''
+    buildings = task["buildings"]
+    cropped_raster, transform, nodata = reproject_crop_raster(task["raster_path"], buildings.total_bounds,
+                                                               task["crs"], verbose=False)
+    per_building = zonal_building_stats(cropped_raster, buildings, transform, nodata, task["height_column"])
+    return task["positions"], per_building
+
+
+def process_buildings_tiled(input_aoi_vector, dsm_raster_path, building_height_vector_path,
+                            output_csv_path='building_stats.csv', updated_vector_path='building_height_updated.gpkg',
+                            tile_size=1000, max_workers=None):
+    '''
+    Tile-parallel version of preprocessing + process_buildings for city-scale AOIs.
+
+    The AOI is split into a grid of tiles, each building is assigned to one tile by its representative point and
+    every tile reads its own DSM window in a worker process. Peak memory per worker is bounded by the tile size.
+    The merged results are written to the same CSV/GPKG outputs as process_buildings.
+
+    :param tile_size: tile edge length in units of the AOI CRS (metres for RD New / UTM)
+    :param max_workers: number of worker processes, defaults to the number of CPUs
+    :return: building_stats, avg_diff, stddev_diff, updated vector (same as process_buildings)
+    '''
+    bbx, crs = get_bbx_and_crs(input_aoi_vector)
+    cropped_vector = reproject_crop_vector(building_height_vector_path, bbx, crs)
+    height_column = find_height_column(cropped_vector)
+    with rasterio.open(dsm_raster_path) as src:
+        describe_reprojection(*resolve_crs(src, crs))
+
+    tile_ids = assign_buildings_to_tiles(cropped_vector, bbx, tile_size)
+    tasks = []
+    for tile_id in np.unique(tile_ids):
+        positions = np.flatnonzero(tile_ids == tile_id)
+        tasks.append({
+            "raster_path": dsm_raster_path,
+            "crs": crs,
+            "height_column": height_column,
+            "positions": positions,
+            "buildings": cropped_vector.iloc[positions][['geometry', height_column]],
+        })
+    print(f"Processing {len(cropped_vector)} buildings in {len(tasks)} tiles of {tile_size} x {tile_size}")
+
+    per_building = [None] * len(cropped_vector)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for positions, tile_stats in executor.map(process_tile, tasks):
+            for position, stats in zip(positions, tile_stats):
+                per_building[position] = stats
+
+    return summarize_building_stats(per_building, cropped_vector, height_column, output_csv_path,
+                                    updated_vector_path)
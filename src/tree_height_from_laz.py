@@ -2,12 +2,33 @@ import laspy
 from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import rasterio
+from rasterio.crs import CRS
 from rasterio.transform import from_origin
+from pyproj import Transformer
+
+from combine_dem_building_tifs import fill_missing_values_with_idw
+from lidar_grid import iter_points_in_bbox, PointThinner, StatisticsGrid, cell_index, grid_max, lattice_from_bounds
+from raster_io import in_memory_raster, warp_to_grid, write_raster
+
+
+def vegetation_filter(points, amplitude_threshold=6.7):
+    """
+    Mask of the points that look like tree canopy: unclassified, between 3.5 and 40 m high,
+    multi-return and below the amplitude threshold.
+    """
+    return (
+            (points['classification'] == 1) &  # Class 1 (unclassified) filter
+            (points.z >= 3.5) &  # Height filter (min)
+            (points.z <= 40.0) &  # Height filter (max)
+            (points['number_of_returns'] > 1) &  # Multi-return filter
+            (points['Amplitude'] < amplitude_threshold)  # Amplitude filter
+    )
 
 
 def filter_tree_canopy(input_path, output_path, bbx, amplitude_threshold = 6.7,
                        min_height=2.0, reflectance_threshold=0.3, min_cluster_area=5,
-                       eps=1.5, min_samples=5, point_density=1.5):
+                       eps=1.5, min_samples=5, point_density=1.5, chunk_size=None, thin_cell_size=None,
+                       thin_keep='highest'):
     """
     Filters and saves vegetation points representing tree canopies from a LAZ file.
 
@@ -21,13 +42,44 @@ def filter_tree_canopy(input_path, output_path, bbx, amplitude_threshold = 6.7,
     - eps: DBSCAN epsilon value for clustering in meters.
     - min_samples: Minimum samples for DBSCAN clustering.
     - point_density: Estimated points per square meter to determine cluster size.
+    - chunk_size: if set, the tile is streamed in chunks of this many points and every chunk is filtered and
+      written on its own, so peak memory stays at one chunk instead of the whole tile.
+    - thin_cell_size: if set (streamed mode only), keep one vegetation point per thin_cell_size x thin_cell_size cell
+      (see lidar_grid.PointThinner); with thin_keep='highest' and a cell size that divides the raster resolution,
+      max-height rasters of the output do not change. The kept points are written once the tile has been read.
+    - thin_keep: point kept per cell when thinning: 'highest', 'lowest' or 'random'.
     """
-    with laspy.open(input_path) as file:
-        las = file.read()
-
     # Unpack bounding box
     min_x, max_x, min_y, max_y = bbx
 
+    if chunk_size:
+        with laspy.open(input_path) as file:
+            header = file.header
+
+        num_points = 0
+        thinner = PointThinner(thin_cell_size, thin_keep) if thin_cell_size else None
+        with laspy.open(output_path, mode='w', header=header) as writer:
+            for points in iter_points_in_bbox(input_path, (min_x, min_y, max_x, max_y), [1], chunk_size):
+                vegetation_points = points[vegetation_filter(points, amplitude_threshold)]
+                if thinner is not None:
+                    thinner.add(vegetation_points)
+                elif len(vegetation_points):
+                    writer.write_points(vegetation_points)
+                    num_points += len(vegetation_points)
+
+            if thinner is not None:
+                vegetation_points = thinner.result()
+                if vegetation_points is not None:
+                    writer.write_points(vegetation_points)
+                    num_points = len(vegetation_points)
+
+        print(f"Number of points after applying combined filters: {num_points}")
+        print(f"Filtered vegetation points saved to {output_path}")
+        return
+
+    with laspy.open(input_path) as file:
+        las = file.read()
+
     # available_fields = list(las.point_format.dimension_names)
     # attributes_to_check = ['classification', 'Z', 'number_of_returns', 'Reflectance']
     # for attr in attributes_to_check:
@@ -74,11 +126,7 @@ def filter_tree_canopy(input_path, output_path, bbx, amplitude_threshold = 6.7,
     combined_filter = (
             (las.x >= min_x) & (las.x <= max_x) &  # Bounding box filter
             (las.y >= min_y) & (las.y <= max_y) &
-            (las['classification'] == 1) &  # Class 1 (unclassified) filter
-            (las.z >= 3.5) &  # Height filter (min)
-            (las.z <= 40.0) &  # Height filter (max)
-            (las['number_of_returns'] > 1) &  # Multi-return filter
-            (las['Amplitude'] < amplitude_threshold)  # Amplitude filter
+            vegetation_filter(las, amplitude_threshold)
     )
 
     # Apply the combined filter
@@ -127,18 +175,88 @@ def filter_tree_canopy(input_path, output_path, bbx, amplitude_threshold = 6.7,
 
 
 
-filter_tree_canopy(
-    input_path= r'C:\Users\www\WRI-cif\Amsterdam\AHN4_C_25EZ1.LAZ',
-    output_path= r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_1.LAZ',
-    bbx=(120764.45790837877, 122764.4639352827, 485845.9530135797, 487845.9552846286),  # Bounding box as (min_x, max_x, min_y, max_y)
-    amplitude_threshold = 6.7,
-    min_height=2.0,
-    min_cluster_area=5,
-    reflectance_threshold=0.3,
-    eps=1.5,
-    min_samples=5,
-    point_density=1.5
-)
+def canopy_height_model(input_paths, output_tif_path, bbx, resolution=1, building_raster_path=None, dem_path=None,
+                        amplitude_threshold=6.7, las_crs='EPSG:28992', chunk_size=2_000_000):
+    """
+    Writes a canopy height model (CHM): the maximum height of the tree canopy points per cell above the ground.
+
+    Every LAZ tile is streamed once. Each chunk adds its vegetation points (see vegetation_filter) to a max-height
+    grid and, unless an aligned DEM is given, its ground points (class 2) to a mean-height DTM grid, both with
+    vectorized reductions. Ground cells without points (e.g. under dense canopy) are filled from the nearest ground
+    cell. The CHM is written as a compressed, tiled float32 GeoTIFF, NaN where there is no canopy.
+
+    Parameters:
+    - input_paths: Path to the input LAZ file, or a list of paths of the tiles covering bbx.
+    - output_tif_path: Path of the CHM GeoTIFF.
+    - bbx: Bounding box as a tuple (min_x, max_x, min_y, max_y) in las_crs.
+    - resolution: Cell size in meters, if no building raster is given.
+    - building_raster_path: Optional building raster; the CHM is then written on its grid (CRS, transform, size).
+    - dem_path: Optional ground DEM to subtract instead of the class 2 points; resampled onto the CHM grid.
+    - amplitude_threshold: Amplitude threshold of the vegetation filter.
+    - las_crs: CRS of the point coordinates.
+    - chunk_size: Number of points decompressed at a time.
+
+    Returns:
+    - output_tif_path.
+    """
+    if isinstance(input_paths, str):
+        input_paths = [input_paths]
+    min_x, max_x, min_y, max_y = bbx
+    las_crs = CRS.from_user_input(las_crs)
+
+    # Grid of the CHM: the building raster lattice, or the bbox snapped to the resolution
+    if building_raster_path:
+        with rasterio.open(building_raster_path) as building:
+            transform, height, width, crs = building.transform, building.height, building.width, building.crs
+    else:
+        transform, height, width = lattice_from_bounds((min_x, min_y, max_x, max_y), resolution)
+        crs = las_crs
+    transformer = Transformer.from_crs(las_crs, crs, always_xy=True) if crs != las_crs else None
+
+    canopy = np.full((height, width), np.nan, dtype=np.float32)
+    ground = StatisticsGrid(height, width, stats=('mean',)) if dem_path is None else None
+    classifications = [1] if dem_path else [1, 2]
+
+    for input_path in input_paths:
+        for points in iter_points_in_bbox(input_path, (min_x, min_y, max_x, max_y), classifications, chunk_size):
+            x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            rows, cols, inside = cell_index(x, y, transform, height, width)
+
+            vegetation = inside & np.asarray(vegetation_filter(points, amplitude_threshold))
+            grid_max(rows[vegetation], cols[vegetation], z[vegetation], height, width, grid=canopy)
+            if ground is not None:
+                is_ground = inside & (np.asarray(points.classification) == 2)
+                ground.add(rows[is_ground], cols[is_ground], z[is_ground])
+
+    grid = in_memory_raster(canopy, transform, crs, np.nan)
+    if ground is not None:
+        dtm = fill_missing_values_with_idw(ground.result()['mean'], np.nan, method='nearest')
+    else:
+        dtm = warp_to_grid(dem_path, grid)['data']
+
+    # Canopy below the ground surface (noise, DTM interpolation) is clipped to 0
+    chm = np.where(np.isnan(canopy), np.nan, np.maximum(canopy - dtm, 0)).astype(np.float32)
+    write_raster(in_memory_raster(chm, transform, crs, np.nan), output_tif_path)
+
+    print(f"Canopy height model with {int((~np.isnan(chm)).sum())} canopy cells saved to {output_tif_path}")
+    return output_tif_path
+
+
+if __name__ == "__main__":
+    filter_tree_canopy(
+        input_path= r'C:\Users\www\WRI-cif\Amsterdam\AHN4_C_25EZ1.LAZ',
+        output_path= r'C:\Users\www\WRI-cif\Amsterdam\Laz_result\aoi2\aoi2_1.LAZ',
+        bbx=(120764.45790837877, 122764.4639352827, 485845.9530135797, 487845.9552846286),  # Bounding box as (min_x, max_x, min_y, max_y)
+        amplitude_threshold = 6.7,
+        min_height=2.0,
+        min_cluster_area=5,
+        reflectance_threshold=0.3,
+        eps=1.5,
+        min_samples=5,
+        point_density=1.5
+    )
 
 
 # 120764.45790837877, 485845.9530135797, 122764.4639352827, 487845.9552846286
@@ -0,0 +1,39 @@
+import geopandas as gpd
+from pyproj import CRS, Transformer
+
+
+def read_vector_schema(vector_path):
+    '''
+    Reads the CRS and the attribute columns of a vector file without parsing its features.
+
+    :return: the CRS of the file and the list of its attribute columns
+    '''
+    sample = gpd.read_file(vector_path, rows=1)
+    return sample.crs, [column for column in sample.columns if column != sample.geometry.name]
+
+
+def read_vector_in_bbox(vector_path, bbx, bbx_crs=None, columns=None):
+    '''
+    Reads only the features of a GeoPackage/GeoJSON that intersect a bounding box.
+    The bounding box is transformed into the CRS of the file and pushed down to the reader, so a GeoPackage is
+    filtered through its spatial index and load time scales with the AOI instead of the file.
+
+    :param vector_path: path or URL of the vector file
+    :param bbx: bounding box (minx, miny, maxx, maxy)
+    :param bbx_crs: CRS of bbx; if None, bbx is assumed to be in the CRS of the file
+    :param columns: optional list of attribute columns to read next to the geometry; names that are not in the
+        file are skipped, so candidate names (e.g. several spellings of a height column) can be passed
+    :return: GeoDataFrame in the CRS of the file, not clipped (features only need to intersect bbx)
+    '''
+    file_crs, file_columns = read_vector_schema(vector_path)
+
+    if bbx_crs is not None and file_crs is not None and CRS.from_user_input(bbx_crs) != file_crs:
+        # Densify the edges so that the transformed box still contains the whole AOI
+        transformer = Transformer.from_crs(bbx_crs, file_crs, always_xy=True)
+        bbx = transformer.transform_bounds(*bbx, densify_pts=21)
+
+    kwargs = {}
+    if columns is not None:
+        kwargs['columns'] = [column for column in columns if column in file_columns]
+
+    return gpd.read_file(vector_path, bbox=tuple(bbx), **kwargs)
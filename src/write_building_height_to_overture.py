@@ -1,6 +1,8 @@
 import geopandas as gpd
 import pandas as pd
 
+from vector_io import read_vector_in_bbox
+
 def transfer_building_heights(overture_path, heights_path, output_path, output_format="GeoJSON"):
     """
     Transfers height values from one building dataset to another based on spatial intersections,
@@ -12,9 +14,10 @@ def transfer_building_heights(overture_path, heights_path, output_path, output_f
         output_path (str): Path to save the updated overture layer.
         output_format (str): Format of the output file ("GeoJSON" or "GPKG").
     """
-    # Load the datasets
+    # Load the datasets; only the height features within the extent of the overture layer are read
     building_overture = gpd.read_file(overture_path)
-    building_heights = gpd.read_file(heights_path)
+    building_heights = read_vector_in_bbox(heights_path, building_overture.total_bounds, building_overture.crs,
+                                           columns=['height'])
 
     # Ensure both GeoDataFrames are using the same coordinate reference system
     building_heights = building_heights.to_crs(building_overture.crs)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from processing import cell_center_building_stats, zonal_building_stats
+
+
+def _compare_methods(footprints, data, transform, nodata_value=None):
+    buildings = gpd.GeoDataFrame({'height': np.arange(len(footprints), dtype=float)}, geometry=footprints)
+    expected = cell_center_building_stats(data, buildings, transform, nodata_value, 'height')
+    actual = zonal_building_stats(data, buildings, transform, nodata_value, 'height')
+
+    assert len(actual) == len(expected)
+    for zonal, cell_centers in zip(actual, expected):
+        if cell_centers is None:
+            assert zonal is None
+            continue
+        assert zonal.num_points == cell_centers.num_points
+        assert np.isclose(zonal.max_val, cell_centers.max_val)
+        assert np.isclose(zonal.min_val, cell_centers.min_val)
+        assert np.isclose(zonal.avg_val, cell_centers.avg_val)
+        assert np.isclose(zonal.stddev_val, cell_centers.stddev_val)
+        assert np.isclose(zonal.avg_diff, cell_centers.avg_diff)
+
+
+def test_edges_on_cell_centers():
+    # The edges of the footprint run through the centers of the cells of a 1 m grid
+    data = np.arange(100, dtype=np.float32).reshape(10, 10)
+    transform = from_origin(0, 10, 1, 1)
+    footprint = box(2.5, 2.5, 7.5, 7.5)
+
+    stats = zonal_building_stats(data, gpd.GeoDataFrame({'height': [0.0]}, geometry=[footprint]), transform,
+                                 None, 'height')
+    assert stats[0].num_points == 16
+    _compare_methods([footprint], data, transform)
+
+
+def test_random_footprints():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0, 30, (60, 60)).astype(np.float32)
+    data[rng.random(data.shape) < 0.05] = -9999
+    transform = from_origin(0, 60, 1, 1)
+
+    # Half of the corners are snapped to cell centers, overlapping and touching footprints included
+    corners = rng.uniform(0, 55, (80, 2))
+    corners[::2] = np.floor(corners[::2]) + 0.5
+    sizes = rng.integers(1, 8, (80, 2)) + np.where(rng.random((80, 1)) < 0.5, 0, 0.3)
+    footprints = [box(x, y, x + w, y + h) for (x, y), (w, h) in zip(corners, sizes)]
+    footprints.append(box(10.5, 10.5, 14.5, 14.5).union(box(14.5, 10.5, 18.5, 12.5)))
+
+    _compare_methods(footprints, data, transform, nodata_value=-9999)
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from pre_processing_new import preprocessing
+from processing import process_buildings
+from streaming_processing import process_buildings_streaming
+from tiled_processing import process_buildings_tiled
+
+
+def _write_inputs(directory, dsm_crs='EPSG:32631'):
+    # AOI and buildings in RD New, DSM in UTM 31N (or without CRS), so every mode has to warp the DSM
+    aoi_path = os.path.join(directory, 'aoi.geojson')
+    gpd.GeoDataFrame(geometry=[box(121000, 487000, 121400, 487400)], crs='EPSG:28992').to_file(aoi_path)
+
+    rng = np.random.default_rng(0)
+    corners = rng.uniform((121005, 487005), (121380, 487380), (150, 2))
+    sizes = rng.uniform(4, 15, (150, 2))
+    buildings_path = os.path.join(directory, 'buildings.gpkg')
+    gpd.GeoDataFrame({'height': rng.uniform(5, 30, 150)},
+                     geometry=[box(x, y, x + w, y + h) for (x, y), (w, h) in zip(corners, sizes)],
+                     crs='EPSG:28992').to_file(buildings_path)
+
+    dsm_path = os.path.join(directory, 'dsm.tif')
+    with rasterio.open(dsm_path, 'w', driver='GTiff', height=900, width=900, count=1, dtype='float32',
+                       crs=dsm_crs, transform=from_origin(628500, 5804300, 0.5, 0.5), nodata=-9999) as dst:
+        dst.write(rng.uniform(0, 40, (1, 900, 900)).astype(np.float32))
+    return aoi_path, dsm_path, buildings_path
+
+
+def _single_pass(directory, aoi_path, dsm_path, buildings_path):
+    cropped_raster, transform, nodata, cropped_vector = preprocessing(aoi_path, dsm_path, buildings_path)
+    csv_path = os.path.join(directory, 'single.csv')
+    process_buildings(cropped_raster, cropped_vector, transform, nodata, csv_path,
+                      os.path.join(directory, 'single.gpkg'), method='zonal')
+    return pd.read_csv(csv_path)
+
+
+def _assert_same_stats(expected, actual):
+    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True))
+
+
+def test_reprojected_dsm_all_modes_agree(tmp_path):
+    directory = str(tmp_path)
+    aoi_path, dsm_path, buildings_path = _write_inputs(directory)
+    expected = _single_pass(directory, aoi_path, dsm_path, buildings_path)
+    assert expected['Num Points'].sum() > 0
+
+    tiled_csv = os.path.join(directory, 'tiled.csv')
+    process_buildings_tiled(aoi_path, dsm_path, buildings_path, tiled_csv, os.path.join(directory, 'tiled.gpkg'),
+                            tile_size=50, max_workers=2)
+    _assert_same_stats(expected, pd.read_csv(tiled_csv))
+
+    streaming_csv = os.path.join(directory, 'streaming.csv')
+    process_buildings_streaming(aoi_path, dsm_path, buildings_path, streaming_csv,
+                                os.path.join(directory, 'streaming.gpkg'), block_size=64, max_blocks=8)
+    _assert_same_stats(expected, pd.read_csv(streaming_csv))
+
+
+def test_dsm_without_crs_streaming_matches_single_pass(tmp_path):
+    # A DSM without CRS is assumed to be in EPSG:7415 and warped to the AOI CRS by every mode
+    directory = str(tmp_path)
+    aoi_path, dsm_path, buildings_path = _write_inputs(directory, dsm_crs=None)
+    with rasterio.open(dsm_path, 'r+') as dst:
+        dst.transform = from_origin(120990.2, 487410.3, 0.5, 0.5)  # Off the snapped AOI lattice
+    expected = _single_pass(directory, aoi_path, dsm_path, buildings_path)
+    assert expected['Num Points'].sum() > 0
+
+    streaming_csv = os.path.join(directory, 'streaming.csv')
+    process_buildings_streaming(aoi_path, dsm_path, buildings_path, streaming_csv,
+                                os.path.join(directory, 'streaming.gpkg'), block_size=64, max_blocks=8)
+    _assert_same_stats(expected, pd.read_csv(streaming_csv))